@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Кэш результатов в памяти процесса (LRU + TTL).
+
+    Каждая запись помечается таблицами, из которых она посчитана;
+    invalidate(table) удаляет только записи, зависящие от этой таблицы.
+    Запись, посчитанная до инвалидации, не сохраняется (счетчик поколений).
+    """
+
+    def __init__(self, maxsize=128, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[2]
+            if entry is not None:
+                del self._data[key]
+                self._stats['evictions'] += 1
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, key, value, tables=(), generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, frozenset(tables), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, table=None):
+        """Сбросить записи, зависящие от таблицы (или весь кэш)"""
+        with self._lock:
+            self._generation += 1
+            self._stats['invalidations'] += 1
+            if table is None:
+                self._data.clear()
+                return
+            for key in [k for k, e in self._data.items() if table in e[1]]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['size'] = len(self._data)
+        s['maxsize'] = self.maxsize
+        s['ttl'] = self.ttl
+        lookups = s['hits'] + s['misses']
+        s['hit_rate'] = round(s['hits'] / lookups, 4) if lookups else 0
+        return s
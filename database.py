@@ -1,17 +1,184 @@
 import os
+import asyncio
+import base64
+import csv
+import gzip
+import io
+import uuid
+import zipfile
 import psycopg2
+import re
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from psycopg2 import extensions
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
-from datetime import datetime
+from cache import ResultCache
+from datetime import datetime, date, time as time_of_day
+from decimal import Decimal
 import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
 import shutil
 from pathlib import Path
 import math
 
 load_dotenv()
 
+class ConnectionPool:
+    """
+    Ограниченный пул долгоживущих соединений.
+    
+    - открыто не более maxconn соединений, остальные запросы ждут (timeout)
+    - minconn соединений открываются сразу и держатся всегда
+    - при выдаче соединение проверяется (закрыто / сломано / долго простаивало)
+    - собираются метрики: занято, ожидают, задержка получения соединения
+    """
+    
+    def __init__(self, minconn, maxconn, timeout=30.0, ping_after=30.0, **params):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.params = params
+        self._idle = []
+        self._opened = 0
+        self._released_at = {}
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._stats = {
+            'in_use': 0,
+            'waiting': 0,
+            'checkouts': 0,
+            'connects': 0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+            'wait_total_ms': 0.0,
+            'wait_max_ms': 0.0
+        }
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+    
+    def _connect(self):
+        conn = psycopg2.connect(**self.params)
+        with self._lock:
+            self._opened += 1
+            self._stats['connects'] += 1
+        return conn
+    
+    def _discard(self, conn):
+        self._released_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._opened -= 1
+    
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        released = self._released_at.get(id(conn))
+        if released is None or time.monotonic() - released < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self):
+        started = time.monotonic()
+        with self._lock:
+            self._stats['waiting'] += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self._stats['waiting'] -= 1
+            if not acquired:
+                self._stats['timeouts'] += 1
+        if not acquired:
+            raise TimeoutError(f"Нет свободных соединений за {self.timeout} с")
+        
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    conn = self._connect()
+                    break
+                if self._is_healthy(conn):
+                    break
+                with self._lock:
+                    self._stats['health_check_failures'] += 1
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        
+        wait_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            self._stats['in_use'] += 1
+            self._stats['checkouts'] += 1
+            self._stats['wait_total_ms'] += wait_ms
+            self._stats['wait_max_ms'] = max(self._stats['wait_max_ms'], wait_ms)
+        return conn
+    
+    def putconn(self, conn):
+        try:
+            broken = conn.closed or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN
+            if not broken and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            if broken:
+                self._discard(conn)
+            else:
+                self._released_at[id(conn)] = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+    
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+    
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['open'] = self._opened
+            s['idle'] = len(self._idle)
+        s['min_size'] = self.minconn
+        s['max_size'] = self.maxconn
+        s['wait_avg_ms'] = round(s['wait_total_ms'] / s['checkouts'], 3) if s['checkouts'] else 0
+        s['wait_total_ms'] = round(s['wait_total_ms'], 3)
+        s['wait_max_ms'] = round(s['wait_max_ms'], 3)
+        return s
+
+class PreparedConnection(extensions.connection):
+    """Соединение пула, помнящее подготовленные на нем (PREPARE) выражения"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.schema_version = 0
+
 class Database:
     def __init__(self):
         self.connection_params = {
@@ -24,6 +191,39 @@ class Database:
         self.pg_dump = "pg_dump"
         self.pg_restore = "pg_restore"
         self.psql = "psql"  # Добавляем psql для SQL файлов
+        self.pool_settings = {
+            'minconn': int(os.getenv('DB_POOL_MIN', '1')),
+            'maxconn': int(os.getenv('DB_POOL_MAX', '10')),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+            'ping_after': float(os.getenv('DB_POOL_PING_AFTER', '30'))
+        }
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._schema = None
+        self._schema_lock = threading.Lock()
+        # Точные COUNT(*) кэшируются ненадолго и сбрасываются при записи в таблицу
+        self._counts = ResultCache(maxsize=1024, ttl=float(os.getenv('COUNTS_TTL', '10')))
+        # Потоки для блокирующей работы (запросы, pandas, pg_dump) из async-обработчиков
+        self.workers = int(os.getenv('DB_WORKERS', self.pool_settings['maxconn']))
+        self.chunk_size = int(os.getenv('EXPORT_CHUNK_SIZE', '5000'))
+        # Строк в одной row group Parquet / record batch Arrow (столько же читается из курсора за раз)
+        self.row_group_size = int(os.getenv('PARQUET_ROW_GROUP_SIZE', '50000'))
+        self.parquet_compression = os.getenv('PARQUET_COMPRESSION', 'zstd')
+        # Сколько таблиц архивируется параллельно (у каждой — свой pg_dump и соединение пула)
+        self.archive_workers = int(os.getenv('ARCHIVE_WORKERS', '4'))
+        # Сколько секунд хранится журнал spzr.quality_changes (чистит триггер)
+        self.quality_changes_retention = int(os.getenv('QUALITY_CHANGES_RETENTION', '3600'))
+        # Сколько ждать текущих записей в таблицу при отметке по id (инкрементальный экспорт)
+        self.watermark_lock_timeout_ms = int(os.getenv('WATERMARK_LOCK_TIMEOUT_MS', '5000'))
+        # Реестр частых запросов: на каждом соединении пула готовятся один раз (PREPARE)
+        self._statements = {}
+        self._statement_stats = {}
+        self._statements_lock = threading.Lock()
+        self._schema_version = 0
+        # Выполняющиеся запросы конструктора: query_id -> соединение (для отмены)
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._executor = None
         self._init_dirs()
     
     def _init_dirs(self):
@@ -35,44 +235,183 @@ class Database:
         for d in self.dirs.values():
             d.mkdir(exist_ok=True)
     
-    def _timestamp_dir(self, base):
+    def _timestamp_dir(self, base, unique=False):
+        """
+        Каталог с отметкой времени; unique=True — отдельный каталог на вызов
+        (для выгрузок с фиксированными именами файлов, которые могут идти параллельно)
+        """
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if unique:
+            base.mkdir(parents=True, exist_ok=True)
+            return Path(tempfile.mkdtemp(prefix=f"{ts}_", dir=base))
         p = base / ts
         p.mkdir(parents=True, exist_ok=True)
         return p
     
-    def get_connection(self, dict_cursor=True):
+    # ---------- Пул соединений ----------
+    def get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        **self.pool_settings,
+                        connection_factory=PreparedConnection,
+                        **self.connection_params
+                    )
+        return self._pool
+    
+    @contextmanager
+    def connection(self, dict_cursor=True):
+        """Соединение из пула (None при ошибке подключения)"""
         try:
-            return psycopg2.connect(
-                **self.connection_params,
-                cursor_factory=RealDictCursor if dict_cursor else None
-            )
+            pool = self.get_pool()
+            conn = pool.getconn()
         except Exception as e:
             print(f"DB conn error: {e}")
-            return None
+            yield None
+            return
+        conn.cursor_factory = RealDictCursor if dict_cursor else extensions.cursor
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+    
+    def get_executor(self):
+        if self._executor is None:
+            with self._pool_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix="db-worker"
+                    )
+        return self._executor
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполнить блокирующую функцию в ограниченном пуле потоков, не блокируя event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), partial(func, *args, **kwargs))
+    
+    def pool_stats(self):
+        if self._pool is None:
+            return {'open': 0, **self.pool_settings}
+        return self._pool.stats()
+    
+    def close(self):
+        with self._pool_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
     
     def execute_query(self, query, params=None, fetch=True):
-        conn = self.get_connection()
-        if not conn:
-            return None
+        with self.connection() as conn:
+            if not conn:
+                return None
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(query, params or ())
+                    if fetch and cur.description:
+                        res = cur.fetchall()
+                    else:
+                        res = None
+                    conn.commit()
+                    return res
+            except Exception as e:
+                conn.rollback()
+                print(f"Query error: {e}\n{query}")
+                return None
+    
+    # ---------- Подготовленные выражения ----------
+    PARAM_REF = re.compile(r'\$(\d+)')
+    
+    def register_statement(self, name, sql):
+        """Зарегистрировать частый запрос под именем; параметры в sql — $1, $2, ..."""
+        nparams = max((int(n) for n in self.PARAM_REF.findall(sql)), default=0)
+        with self._statements_lock:
+            if name in self._statements and self._statements[name][0] != sql:
+                raise ValueError(f"Выражение {name} уже зарегистрировано с другим SQL")
+            self._statements[name] = (sql, nparams)
+            self._statement_stats.setdefault(name, {
+                'calls': 0, 'prepares': 0, 'errors': 0, 'rows': 0, 'total_ms': 0.0, 'max_ms': 0.0
+            })
+        return name
+    
+    def _record_statement(self, name, started, prepared, rows):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._statements_lock:
+            st = self._statement_stats[name]
+            st['calls'] += 1
+            st['prepares'] += prepared
+            if rows is None:
+                st['errors'] += 1
+            else:
+                st['rows'] += rows
+            st['total_ms'] += elapsed_ms
+            st['max_ms'] = max(st['max_ms'], elapsed_ms)
+    
+    def _forget_prepared(self, conn, name):
+        """После ошибки план мог устареть — выражение будет подготовлено заново"""
+        if name not in conn.prepared:
+            return
+        conn.prepared.discard(name)
         try:
             with conn.cursor() as cur:
-                cur.execute(query, params or ())
-                if fetch and cur.description:
-                    res = cur.fetchall()
-                else:
-                    res = None
-                conn.commit()
-                return res
-        except Exception as e:
+                cur.execute(f"DEALLOCATE {name}")
+            conn.commit()
+        except Exception:
             conn.rollback()
-            print(f"Query error: {e}\n{query}")
-            return None
-        finally:
-            conn.close()
     
-    def execute_sql_file(self, filepath):
-        """Выполнить SQL файл через psql"""
+    def execute_prepared(self, name, params=()):
+        """
+        Выполнить зарегистрированный запрос через EXECUTE.
+        
+        На соединении выражение готовится (PREPARE) при первом вызове и дальше
+        не разбирается заново; после DDL (invalidate_schema) подготовленные
+        выражения соединения сбрасываются. Результат — как у execute_query.
+        """
+        sql, nparams = self._statements[name]
+        with self.connection() as conn:
+            if not conn:
+                return None
+            started = time.perf_counter()
+            prepared = False
+            try:
+                with conn.cursor() as cur:
+                    if conn.schema_version != self._schema_version:
+                        cur.execute("DEALLOCATE ALL")
+                        conn.prepared.clear()
+                        conn.schema_version = self._schema_version
+                    if name not in conn.prepared:
+                        cur.execute(f"PREPARE {name} AS {sql}")
+                        conn.prepared.add(name)
+                        prepared = True
+                    args = f"({', '.join(['%s'] * nparams)})" if nparams else ""
+                    cur.execute(f"EXECUTE {name}{args}", tuple(params))
+                    res = cur.fetchall() if cur.description else None
+                    conn.commit()
+            except Exception as e:
+                conn.rollback()
+                self._forget_prepared(conn, name)
+                self._record_statement(name, started, prepared, None)
+                print(f"Query error: {e}\n{name}")
+                return None
+            self._record_statement(name, started, prepared, len(res) if res else 0)
+            return res
+    
+    def statement_stats(self):
+        """Число вызовов, подготовок и время выполнения по каждому выражению реестра"""
+        with self._statements_lock:
+            stats = {name: dict(st) for name, st in self._statement_stats.items()}
+        for st in stats.values():
+            st['avg_ms'] = round(st['total_ms'] / st['calls'], 3) if st['calls'] else 0
+            st['total_ms'] = round(st['total_ms'], 3)
+            st['max_ms'] = round(st['max_ms'], 3)
+        return stats
+    
+    def execute_sql_file(self, filepath, progress=None):
+        """Выполнить SQL файл через psql; progress(**поля) получает время выполнения"""
         try:
             db = os.getenv('DB_NAME', 'clothing_warehouse')
             user = os.getenv('DB_USER', 'postgres')
@@ -89,41 +428,649 @@ class Database:
                 '-v', 'ON_ERROR_STOP=1'
             ]
             
-            env = os.environ.copy()
-            env['PGPASSWORD'] = os.getenv('DB_PASSWORD', 'postgres')
-            
-            result = subprocess.run(
-                cmd,
-                env=env,
-                capture_output=True,
-                text=True
-            )
+            t0 = time.monotonic()
+            tick = None
+            if progress:
+                progress(phase='sql', bytes=Path(filepath).stat().st_size, seconds=0)
+                tick = lambda: progress(seconds=round(time.monotonic() - t0, 3))
+            returncode, log = self._run_tool(cmd, tick=tick)
+            self.invalidate_schema()
             
-            if result.returncode == 0:
+            if returncode == 0:
                 return True, "SQL файл успешно выполнен"
             else:
-                return False, result.stderr
+                return False, '\n'.join(log)
                 
         except Exception as e:
             return False, str(e)
     
+    # ---------- Метаданные схемы ----------
+    FK_RULES = {'a': 'NO ACTION', 'r': 'RESTRICT', 'c': 'CASCADE', 'n': 'SET NULL', 'd': 'SET DEFAULT'}
+    
+    def _load_schema_metadata(self):
+        """Колонки, PK, FK и индексы всех таблиц схемы public — три запроса к pg_catalog"""
+        columns = self.execute_query("""
+            SELECT
+                c.relname AS table_name,
+                c.relkind,
+                a.attname AS column_name,
+                format_type(a.atttypid, NULL) AS data_type,
+                format_type(a.atttypid, a.atttypmod) AS full_type,
+                CASE WHEN a.attnotnull THEN 'NO' ELSE 'YES' END AS is_nullable,
+                pg_get_expr(d.adbin, d.adrelid) AS column_default
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+            LEFT JOIN pg_attrdef d ON d.adrelid = c.oid AND d.adnum = a.attnum
+            WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p', 'v', 'f')
+            ORDER BY c.relname, a.attnum
+        """)
+        constraints = self.execute_query("""
+            SELECT
+                con.contype,
+                cl.relname AS table_name,
+                a.attname AS column_name,
+                fcl.relname AS foreign_table,
+                fa.attname AS foreign_column,
+                con.confupdtype AS update_rule,
+                con.confdeltype AS delete_rule
+            FROM pg_constraint con
+            JOIN pg_class cl ON cl.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = cl.relnamespace
+            CROSS JOIN LATERAL unnest(con.conkey, con.confkey) WITH ORDINALITY AS k(attnum, fattnum, ord)
+            JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+            LEFT JOIN pg_class fcl ON fcl.oid = con.confrelid
+            LEFT JOIN pg_attribute fa ON fa.attrelid = con.confrelid AND fa.attnum = k.fattnum
+            WHERE n.nspname = 'public' AND con.contype IN ('p', 'f')
+            ORDER BY cl.relname, con.oid, k.ord
+        """)
+        indexes = self.execute_query("""
+            SELECT DISTINCT c.relname AS table_name, a.attname AS column_name
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE n.nspname = 'public' AND i.indisvalid AND i.indpred IS NULL
+            ORDER BY c.relname, a.attname
+        """)
+        if columns is None or constraints is None or indexes is None:
+            return None
+        
+        meta = {'tables': [], 'columns': {}, 'primary_keys': {}, 'foreign_keys': {}, 'indexed': {}, 'kinds': {}}
+        for col in columns:
+            table = col.pop('table_name')
+            kind = col.pop('relkind')
+            if table not in meta['columns']:
+                meta['tables'].append(table)
+                meta['columns'][table] = []
+            # relkind: r — таблица, p — секционированная, v — представление, f — внешняя
+            meta['kinds'][table] = kind
+            meta['columns'][table].append(dict(col))
+        for con in constraints:
+            table = con['table_name']
+            if con['contype'] == 'p':
+                meta['primary_keys'].setdefault(table, []).append(con['column_name'])
+            else:
+                meta['foreign_keys'].setdefault(table, []).append({
+                    'column_name': con['column_name'],
+                    'foreign_table': con['foreign_table'],
+                    'foreign_column': con['foreign_column'],
+                    'update_rule': self.FK_RULES.get(con['update_rule']),
+                    'delete_rule': self.FK_RULES.get(con['delete_rule'])
+                })
+        # Ведущие колонки индексов — по ним возможна keyset-пагинация
+        for idx in indexes:
+            meta['indexed'].setdefault(idx['table_name'], []).append(idx['column_name'])
+        return meta
+    
+    def get_schema_metadata(self):
+        """Метаданные схемы из кэша; кэш сбрасывается только при DDL (invalidate_schema)"""
+        meta = self._schema
+        if meta is None:
+            with self._schema_lock:
+                meta = self._schema
+                if meta is None:
+                    meta = self._load_schema_metadata()
+                    self._schema = meta
+        return meta or {'tables': [], 'columns': {}, 'primary_keys': {}, 'foreign_keys': {}, 'indexed': {}, 'kinds': {}}
+    
+    def invalidate_schema(self):
+        with self._schema_lock:
+            self._schema = None
+            # подготовленные выражения могли устареть (изменились типы колонок)
+            self._schema_version += 1
+        # DDL / восстановление меняют и содержимое таблиц
+        self._counts.invalidate()
+    
     def get_tables(self):
-        q = "SELECT table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_name"
-        res = self.execute_query(q)
-        return [r['table_name'] for r in res] if res else []
+        return list(self.get_schema_metadata()['tables'])
     
     def get_table_columns(self, table):
-        q = """
-            SELECT column_name, data_type, is_nullable, column_default
-            FROM information_schema.columns
-            WHERE table_name = %s ORDER BY ordinal_position
+        return self.get_schema_metadata()['columns'].get(table, [])
+    
+    # ---------- Количество строк ----------
+    def get_table_counts(self, tables=None, mode='exact'):
+        """
+        Число строк для списка таблиц (по умолчанию — всех).
+        
+        mode='exact'    — COUNT(*) всех некэшированных таблиц одним запросом (UNION ALL),
+                          результат кэшируется на COUNTS_TTL секунд;
+        mode='estimate' — оценка по статистике (pg_stat_user_tables / pg_class.reltuples)
+                          без чтения таблиц; для представлений — точный счет.
         """
-        return self.execute_query(q, (table,))
+        tables = self.get_tables() if tables is None else list(tables)
+        counts = {}
+        
+        if mode == 'estimate':
+            res = self.execute_query("""
+                SELECT c.relname AS t,
+                       COALESCE(NULLIF(s.n_live_tup, 0), GREATEST(c.reltuples, 0))::bigint AS c
+                FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND c.relname = ANY(%s)
+            """, (tables,)) or []
+            counts = {r['t']: r['c'] for r in res}
+        
+        generation = self._counts.generation()
+        missing = []
+        for t in tables:
+            if t in counts:
+                continue
+            cached = self._counts.get(t)
+            if cached is None:
+                missing.append(t)
+            else:
+                counts[t] = cached
+        
+        if missing:
+            q = " UNION ALL ".join(
+                f"SELECT %s AS t, COUNT(*) AS c FROM {t}" for t in missing
+            )
+            res = self.execute_query(q, tuple(missing)) or []
+            for r in res:
+                counts[r['t']] = r['c']
+                self._counts.set(r['t'], r['c'], (r['t'],), generation)
+        
+        return {t: counts.get(t, 0) for t in tables}
     
     def get_table_count(self, table):
-        q = f"SELECT COUNT(*) as c FROM {table}"
-        res = self.execute_query(q)
-        return res[0]['c'] if res else 0
+        return self.get_table_counts([table])[table]
+    
+    def invalidate_counts(self, table=None):
+        self._counts.invalidate(table)
+    
+    # ---------- Индексы ----------
+    # Индексы под запросы приложения (в дополнение к PK и UNIQUE из схемы);
+    # UNIQUE(product_id, supplier_id, characteristic_id) уже покрывает доступ по product_id
+    MANAGED_INDEXES = [
+        {
+            'name': 'idx_pc_characteristic',
+            'table': 'product_characteristics',
+            'columns': ('characteristic_id',),
+            'include': ('real_value', 'min_norm', 'max_norm'),
+            'reason': 'статистика по характеристикам (index-only scan), каскад из characteristics'
+        },
+        {
+            'name': 'idx_pc_supplier_product',
+            'table': 'product_characteristics',
+            'columns': ('supplier_id', 'product_id'),
+            'reason': 'выборка по поставщику, каскад и проверка ссылок из suppliers'
+        }
+    ]
+    SEQ_SCAN_MIN_ROWS = 1000
+    
+    @staticmethod
+    def _index_ddl(index, concurrently=False):
+        mode = 'CONCURRENTLY ' if concurrently else ''
+        ddl = f"CREATE INDEX {mode}IF NOT EXISTS {index['name']} ON {index['table']} ({', '.join(index['columns'])})"
+        if index.get('include'):
+            ddl += f" INCLUDE ({', '.join(index['include'])})"
+        return ddl
+    
+    def _existing_indexes(self, valid=True):
+        """
+        Имена индексов схемы public. Прерванный CREATE INDEX CONCURRENTLY оставляет
+        индекс с indisvalid = false: он есть в pg_indexes, но не используется
+        планировщиком — такие индексы возвращаются только при valid=False
+        """
+        res = self.execute_query("""
+            SELECT c.relname AS indexname
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public' AND i.indisvalid = %s
+        """, (valid,))
+        return {r['indexname'] for r in res or []}
+    
+    def ensure_indexes(self, concurrently=False):
+        """
+        Создать недостающие индексы из MANAGED_INDEXES (для существующих таблиц).
+        concurrently=True — без блокировки записи (CREATE INDEX CONCURRENTLY, вне транзакции).
+        Невалидные индексы набора (после неудачной попытки) удаляются и строятся заново.
+        Возвращает список созданных индексов.
+        """
+        tables = set(self.get_tables())
+        existing = self._existing_indexes()
+        missing = [i for i in self.MANAGED_INDEXES if i['table'] in tables and i['name'] not in existing]
+        if not missing:
+            return []
+        invalid = self._existing_indexes(valid=False)
+        mode = 'CONCURRENTLY ' if concurrently else ''
+        
+        created = []
+        with self.connection() as conn:
+            if not conn:
+                return created
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    for index in missing:
+                        try:
+                            if index['name'] in invalid:
+                                cur.execute(f"DROP INDEX {mode}IF EXISTS {index['name']}")
+                            cur.execute(self._index_ddl(index, concurrently))
+                            created.append(index['name'])
+                        except Exception as e:
+                            print(f"Index error: {e}\n{index['name']}")
+            finally:
+                conn.autocommit = False
+        self.invalidate_schema()
+        return created
+    
+    def _pg_stat_statements(self, limit):
+        """Самые затратные запросы к таблицам схемы (если установлено расширение pg_stat_statements)"""
+        ext = self.execute_query("SELECT 1 AS ok FROM pg_extension WHERE extname = 'pg_stat_statements'")
+        if not ext:
+            return None
+        cols = {r['attname'] for r in self.execute_query("""
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = 'pg_stat_statements'::regclass AND attnum > 0
+        """) or []}
+        # PostgreSQL 13+: total_exec_time / mean_exec_time, раньше — total_time / mean_time
+        total, mean = ('total_exec_time', 'mean_exec_time') if 'total_exec_time' in cols else ('total_time', 'mean_time')
+        return self.execute_query(f"""
+            SELECT query, calls,
+                   round({total}::numeric, 3) AS total_ms,
+                   round({mean}::numeric, 3) AS mean_ms,
+                   rows
+            FROM pg_stat_statements
+            WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+              AND query ~* 'product_characteristics|products|suppliers|characteristics'
+            ORDER BY {total} DESC
+            LIMIT %s
+        """, (limit,))
+    
+    def index_advice(self, top_statements=10):
+        """
+        Рекомендации по индексам:
+        - недостающие индексы из MANAGED_INDEXES (формы запросов приложения);
+        - FK-колонки без индекса, в котором они ведущие (каскады, проверка ссылок);
+        - таблицы, которые читаются в основном последовательным сканированием
+          (pg_stat_user_tables), и самые затратные запросы (pg_stat_statements).
+        """
+        meta = self.get_schema_metadata()
+        existing = self._existing_indexes()
+        proposals = []
+        covered = {t: set(cols) for t, cols in meta['indexed'].items()}
+        
+        for index in self.MANAGED_INDEXES:
+            if index['table'] in meta['columns'] and index['name'] not in existing:
+                proposals.append({
+                    'table': index['table'],
+                    'index': index['name'],
+                    'ddl': self._index_ddl(index),
+                    'reason': index['reason'],
+                    'managed': True
+                })
+                covered.setdefault(index['table'], set()).add(index['columns'][0])
+        
+        for table, fks in meta['foreign_keys'].items():
+            for fk in fks:
+                col = fk['column_name']
+                if col in covered.get(table, set()):
+                    continue
+                covered.setdefault(table, set()).add(col)
+                name = f"idx_{table}_{col}"
+                proposals.append({
+                    'table': table,
+                    'index': name,
+                    'ddl': f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({col})",
+                    'reason': (f"FK на {fk['foreign_table']} (ON DELETE {fk['delete_rule']}) без индекса: "
+                               f"удаление из {fk['foreign_table']} и проверка ссылок сканируют {table}"),
+                    'managed': False
+                })
+        
+        scans = self.execute_query("""
+            SELECT relname AS table, seq_scan, seq_tup_read,
+                   COALESCE(idx_scan, 0) AS idx_scan, n_live_tup
+            FROM pg_stat_user_tables
+            WHERE schemaname = 'public'
+            ORDER BY seq_tup_read DESC
+        """) or []
+        for row in scans:
+            row['seq_scan_heavy'] = (
+                row['n_live_tup'] >= self.SEQ_SCAN_MIN_ROWS and row['seq_scan'] > row['idx_scan']
+            )
+        
+        return {
+            'proposals': proposals,
+            'table_scans': scans,
+            'statements': self._pg_stat_statements(top_statements)
+        }
+    
+    # ---------- Сводка качества (spzr.quality_scores) ----------
+    # Таблица поддерживается триггерами на product_characteristics: запись
+    # пересчитывает только затронутые группы (продукт × поставщик).
+    # Единственное место, где описана схема сводки: init.sql ее не создает.
+    QUALITY_SCORES_DDL = """
+        -- Градация при заданном Δx — та же формула, что spzr.calculate_gradations
+        CREATE OR REPLACE FUNCTION spzr_gradation(x DOUBLE PRECISION, xmin DOUBLE PRECISION,
+                                                  xmax DOUBLE PRECISION, dx DOUBLE PRECISION)
+        RETURNS INTEGER AS $$
+            SELECT CASE
+                WHEN x >= xmin AND x <= xmax THEN 2
+                WHEN x > xmax THEN LEAST(GREATEST(ceil((x - xmax) / dx) + 1, 2), 100)::int
+                ELSE LEAST(GREATEST(ceil((xmin - x) / dx) + 1, 2), 100)::int
+            END
+        $$ LANGUAGE sql IMMUTABLE;
+
+        -- Контрольная сумма измерения: сумма по группе в quality_scores сверяется
+        -- с измерениями (scoring.score_rows) — сводку, записанную без триггеров, видно
+        CREATE OR REPLACE FUNCTION quality_measurement_hash(x DOUBLE PRECISION, xmin DOUBLE PRECISION,
+                                                            xmax DOUBLE PRECISION)
+        RETURNS INTEGER AS $$
+            SELECT hashtext(concat_ws('|', x, xmin, xmax))
+        $$ LANGUAGE sql IMMUTABLE;
+
+        -- Служебные таблицы — в своей схеме: get_tables() (public) их не видит,
+        -- значит их нельзя удалить, архивировать или выгрузить как пользовательские.
+        -- Ранее они создавались в public; сводка пересчитывается заново, журнал временный
+        CREATE SCHEMA IF NOT EXISTS spzr;
+        DROP TABLE IF EXISTS public.quality_scores, public.quality_changes;
+
+        -- Сводка качества по группам (продукт × поставщик) при базовом Δx = 1.0
+        CREATE TABLE IF NOT EXISTS spzr.quality_scores (
+            product_id INTEGER NOT NULL,
+            supplier_id INTEGER NOT NULL,
+            measurements INTEGER NOT NULL,
+            ch INTEGER NOT NULL,
+            co DOUBLE PRECISION NOT NULL,
+            checksum BIGINT NOT NULL DEFAULT 0,
+            go DOUBLE PRECISION GENERATED ALWAYS AS (co / ch) STORED,
+            base_p DOUBLE PRECISION GENERATED ALWAYS AS (exp(-ln(2) / ((co / ch) * (co / ch)))) STORED,
+            is_quality BOOLEAN GENERATED ALWAYS AS (exp(-ln(2) / ((co / ch) * (co / ch))) <= 0.5) STORED,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (product_id, supplier_id)
+        );
+        ALTER TABLE spzr.quality_scores ADD COLUMN IF NOT EXISTS checksum BIGINT NOT NULL DEFAULT 0;
+        CREATE INDEX IF NOT EXISTS idx_quality_scores_verdict ON spzr.quality_scores (is_quality, base_p);
+
+        -- Журнал затронутых групп (xid транзакции) для инкрементального пересчета
+        -- analyze-all (scoring.ScoringEngine); reset — TRUNCATE, сбросить все
+        CREATE TABLE IF NOT EXISTS spzr.quality_changes (
+            xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+            product_id INTEGER,
+            supplier_id INTEGER,
+            reset BOOLEAN NOT NULL DEFAULT FALSE,
+            changed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+        );
+        CREATE INDEX IF NOT EXISTS idx_quality_changes_xid ON spzr.quality_changes (xid);
+        CREATE INDEX IF NOT EXISTS idx_quality_changes_changed_at ON spzr.quality_changes (changed_at);
+
+        -- Пересчет групп (NULL — всех). log₂(n) считается в numeric и округляется
+        -- до double так же, как math.log2; суммы накапливаются в порядке id, как в spzr.score_groups
+        CREATE OR REPLACE FUNCTION refresh_quality_scores(p_products INTEGER[], p_suppliers INTEGER[])
+        RETURNS void AS $$
+        DECLARE
+            g RECORD;
+        BEGIN
+            IF p_products IS NULL THEN
+                LOCK TABLE spzr.quality_scores IN EXCLUSIVE MODE;
+                DELETE FROM spzr.quality_scores;
+            ELSE
+                -- группы блокируются в одном порядке: параллельные записи в одну группу не теряются
+                FOR g IN
+                    SELECT DISTINCT u.product_id, u.supplier_id
+                    FROM unnest(p_products, p_suppliers) AS u(product_id, supplier_id)
+                    WHERE u.product_id IS NOT NULL AND u.supplier_id IS NOT NULL
+                    ORDER BY 1, 2
+                LOOP
+                    PERFORM pg_advisory_xact_lock(g.product_id, g.supplier_id);
+                END LOOP;
+                DELETE FROM spzr.quality_scores q
+                USING unnest(p_products, p_suppliers) AS u(product_id, supplier_id)
+                WHERE q.product_id = u.product_id AND q.supplier_id = u.supplier_id;
+            END IF;
+
+            INSERT INTO spzr.quality_scores (product_id, supplier_id, measurements, ch, co, checksum)
+            SELECT pc.product_id, pc.supplier_id,
+                   count(*),
+                   count(pc.characteristic_id),
+                   sum(l.value ORDER BY pc.id) FILTER (WHERE pc.characteristic_id IS NOT NULL),
+                   sum(quality_measurement_hash(pc.real_value, pc.min_norm, pc.max_norm))
+            FROM product_characteristics pc
+            JOIN (
+                SELECT n, (ln(n::numeric(40, 30)) / ln(2::numeric(40, 30)))::float8 AS value
+                FROM generate_series(2, 100) AS n
+            ) l ON l.n = spzr_gradation(pc.real_value, pc.min_norm, pc.max_norm, 1.0)
+            WHERE pc.product_id IS NOT NULL AND pc.supplier_id IS NOT NULL
+              AND (p_products IS NULL OR (pc.product_id, pc.supplier_id) IN (
+                  SELECT * FROM unnest(p_products, p_suppliers)
+              ))
+            GROUP BY pc.product_id, pc.supplier_id
+            HAVING count(pc.characteristic_id) > 0;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Журнал чистится при каждой записи, независимо от того, читает ли его
+        -- приложение: строки старше quality_changes_retention (QUALITY_CHANGES_RETENTION).
+        -- Строки, которые уже удаляет параллельная транзакция, пропускаются
+        CREATE OR REPLACE FUNCTION quality_changes_retention() RETURNS interval AS $$
+            SELECT make_interval(secs => %(retention)s)
+        $$ LANGUAGE sql IMMUTABLE;
+
+        CREATE OR REPLACE FUNCTION trim_quality_changes() RETURNS void AS $$
+            DELETE FROM spzr.quality_changes
+            WHERE ctid IN (
+                SELECT ctid FROM spzr.quality_changes
+                WHERE changed_at < clock_timestamp() - quality_changes_retention()
+                FOR UPDATE SKIP LOCKED
+            )
+        $$ LANGUAGE sql;
+
+        -- Триггеры уровня оператора: затронутые группы пересчитываются один раз на запрос
+        CREATE OR REPLACE FUNCTION quality_scores_sync() RETURNS trigger AS $$
+        DECLARE
+            products INTEGER[];
+            suppliers INTEGER[];
+        BEGIN
+            PERFORM trim_quality_changes();
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM spzr.quality_scores;
+                INSERT INTO spzr.quality_changes (reset) VALUES (TRUE);
+                RETURN NULL;
+            ELSIF TG_OP = 'INSERT' THEN
+                SELECT array_agg(product_id), array_agg(supplier_id) INTO products, suppliers
+                FROM (SELECT DISTINCT product_id, supplier_id FROM new_rows) g;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT array_agg(product_id), array_agg(supplier_id) INTO products, suppliers
+                FROM (SELECT DISTINCT product_id, supplier_id FROM old_rows) g;
+            ELSE
+                SELECT array_agg(product_id), array_agg(supplier_id) INTO products, suppliers
+                FROM (
+                    SELECT product_id, supplier_id FROM new_rows
+                    UNION
+                    SELECT product_id, supplier_id FROM old_rows
+                ) g;
+            END IF;
+            IF products IS NOT NULL THEN
+                PERFORM refresh_quality_scores(products, suppliers);
+                INSERT INTO spzr.quality_changes (product_id, supplier_id)
+                SELECT * FROM unnest(products, suppliers);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS quality_scores_insert ON product_characteristics;
+        DROP TRIGGER IF EXISTS quality_scores_update ON product_characteristics;
+        DROP TRIGGER IF EXISTS quality_scores_delete ON product_characteristics;
+        DROP TRIGGER IF EXISTS quality_scores_truncate ON product_characteristics;
+        CREATE TRIGGER quality_scores_insert AFTER INSERT ON product_characteristics
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION quality_scores_sync();
+        CREATE TRIGGER quality_scores_update AFTER UPDATE ON product_characteristics
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION quality_scores_sync();
+        CREATE TRIGGER quality_scores_delete AFTER DELETE ON product_characteristics
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION quality_scores_sync();
+        CREATE TRIGGER quality_scores_truncate AFTER TRUNCATE ON product_characteristics
+            FOR EACH STATEMENT EXECUTE FUNCTION quality_scores_sync();
+    """
+    
+    def ensure_quality_scores(self):
+        """Создать схему spzr (сводка и журнал), функции и триггеры и пересчитать все группы (идемпотентно)"""
+        with self.connection() as conn:
+            if not conn:
+                return False
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(self.QUALITY_SCORES_DDL, {'retention': self.quality_changes_retention})
+                    cur.execute("SELECT refresh_quality_scores(NULL, NULL)")
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Quality scores error: {e}")
+                return False
+        self.invalidate_schema()
+        return True
+    
+    # ---------- Keyset-пагинация ----------
+    def get_sort_columns(self, table):
+        """
+        Колонки, по которым возможна keyset-пагинация: PK и NOT NULL колонки,
+        ведущие в индексе (NULL ломает сравнение кортежей)
+        """
+        meta = self.get_schema_metadata()
+        pk = meta['primary_keys'].get(table, [])
+        not_null = {c['column_name'] for c in meta['columns'].get(table, []) if c['is_nullable'] == 'NO'}
+        indexed = [c for c in meta['indexed'].get(table, []) if c in not_null and c not in pk]
+        return pk[:1] + indexed if pk else indexed
+    
+    @staticmethod
+    def encode_cursor(values):
+        raw = json.dumps(values, default=str, ensure_ascii=False).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+    
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(raw.decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Некорректный курсор")
+        if not isinstance(values, list):
+            raise ValueError("Некорректный курсор")
+        return values
+    
+    def get_table_page(self, table, limit=100, cursor=None, direction='next', sort=None):
+        """
+        Страница таблицы по ключу (keyset): WHERE (sort, pk) > (курсор) ORDER BY sort, pk LIMIT n.
+        
+        Стоимость не зависит от номера страницы — индекс сразу позиционируется
+        на курсор, пропущенные строки не читаются. Ключ — колонка sort
+        (из get_sort_columns) с PK для однозначности; без PK — ctid обычной таблицы.
+        У представлений и внешних таблиц без ключа ctid нет — страницы по OFFSET
+        (курсор хранит смещение), как в get_table_data.
+        direction='prev' читает страницу перед курсором; prev без курсора — последняя страница.
+        Возвращает rows, next_cursor, prev_cursor (None — страницы нет) и sort.
+        """
+        meta = self.get_schema_metadata()
+        if table not in meta['columns']:
+            raise ValueError(f"Таблица {table} не найдена")
+        if direction not in ('next', 'prev'):
+            raise ValueError("direction должен быть next или prev")
+        
+        pk = meta['primary_keys'].get(table, [])
+        allowed = self.get_sort_columns(table)
+        if sort is None:
+            if not allowed and meta['kinds'].get(table) != 'r':
+                return self._offset_page(table, limit, cursor, direction == 'prev')
+            sort = allowed[0] if allowed else 'ctid'
+        elif sort not in allowed:
+            raise ValueError(f"Сортировка по {sort} недоступна: нужна NOT NULL колонка с индексом")
+        key = [sort] + [c for c in pk if c != sort] if sort != 'ctid' else ['ctid']
+        
+        key_list = ', '.join(key)
+        back = direction == 'prev'
+        order = ', '.join(f"{c} {'DESC' if back else 'ASC'}" for c in key)
+        where, params = '', []
+        if cursor:
+            values = self.decode_cursor(cursor)
+            if len(values) != len(key):
+                raise ValueError("Курсор не соответствует сортировке")
+            ph = ', '.join(['%s::tid'] * len(key)) if key == ['ctid'] else ', '.join(['%s'] * len(key))
+            where = f"WHERE ({key_list}) {'<' if back else '>'} ({ph})"
+            params = values
+        
+        by_ctid = key == ['ctid']
+        columns = "ctid::text AS _ctid, *" if by_ctid else "*"
+        q = f"SELECT {columns} FROM {table} {where} ORDER BY {order} LIMIT %s"
+        rows = self.execute_query(q, tuple(params) + (limit + 1,))
+        if rows is None:
+            return None
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if back:
+            rows.reverse()
+        if by_ctid:
+            keys = [[r.pop('_ctid')] for r in rows]
+        else:
+            keys = [[r[c] for c in key] for r in rows]
+        
+        if back:
+            prev_cursor = self.encode_cursor(keys[0]) if rows and has_more else None
+            next_cursor = self.encode_cursor(keys[-1]) if rows and cursor else None
+        else:
+            prev_cursor = self.encode_cursor(keys[0]) if rows and cursor else None
+            next_cursor = self.encode_cursor(keys[-1]) if rows and has_more else None
+        return {
+            'rows': rows,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
+            'sort': sort,
+            'sort_columns': allowed
+        }
+    
+    def _offset_page(self, table, limit, cursor, back):
+        """Страница без ключа сортировки: курсор — [смещение] начала (next) или конца (prev) страницы"""
+        if cursor:
+            values = self.decode_cursor(cursor)
+            if len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+                raise ValueError("Курсор не соответствует сортировке")
+            position = values[0]
+        elif back:
+            position = self.get_table_count(table)
+        else:
+            position = 0
+        offset = max(0, position - limit) if back else position
+        
+        rows = self.execute_query(f"SELECT * FROM {table} LIMIT %s OFFSET %s", (limit + 1, offset))
+        if rows is None:
+            return None
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        end = offset + len(rows)
+        return {
+            'rows': rows,
+            'next_cursor': self.encode_cursor([end]) if has_more else None,
+            'prev_cursor': self.encode_cursor([offset]) if offset > 0 else None,
+            'sort': None,
+            'sort_columns': []
+        }
     
     def get_table_data(self, table, limit=None, offset=0):
         if limit:
@@ -136,109 +1083,552 @@ class Database:
         ph = ', '.join(['%s'] * len(data))
         q = f"INSERT INTO {table} ({cols}) VALUES ({ph}) RETURNING id"
         res = self.execute_query(q, tuple(data.values()))
+        self.invalidate_counts(table)
         return res[0]['id'] if res else None
     
     def update_data(self, table, data, condition):
         set_clause = ', '.join([f"{k}=%s" for k in data.keys()])
         q = f"UPDATE {table} SET {set_clause} WHERE {condition}"
-        conn = self.get_connection(dict_cursor=False)
-        if not conn: return None
-        try:
-            with conn.cursor() as cur:
-                cur.execute(q, tuple(data.values()))
-                conn.commit()
-                return cur.rowcount > 0
-        except:
-            conn.rollback()
-            return None
-        finally:
-            conn.close()
+        with self.connection(dict_cursor=False) as conn:
+            if not conn: return None
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(q, tuple(data.values()))
+                    conn.commit()
+                    return cur.rowcount > 0
+            except:
+                conn.rollback()
+                return None
     
     def delete_data(self, table, condition):
-        conn = self.get_connection(dict_cursor=False)
-        if not conn: return None
-        try:
-            with conn.cursor() as cur:
-                cur.execute(f"DELETE FROM {table} WHERE {condition}")
-                conn.commit()
-                return cur.rowcount > 0
-        except:
-            conn.rollback()
-            return None
-        finally:
-            conn.close()
+        with self.connection(dict_cursor=False) as conn:
+            if not conn: return None
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f"DELETE FROM {table} WHERE {condition}")
+                    conn.commit()
+                    # Каскадное удаление меняет и дочерние таблицы
+                    self.invalidate_counts()
+                    return cur.rowcount > 0
+            except:
+                conn.rollback()
+                return None
     
     def delete_data_safe(self, table, condition):
         """Проверка зависимостей перед удалением"""
-        conn = self.get_connection(dict_cursor=False)
-        if not conn:
-            return {'success': False, 'error': 'No connection'}
+        # Внешние ключи, ссылающиеся на таблицу (из кэша метаданных)
+        refs = [
+            (child, fk['column_name'])
+            for child, fks in self.get_schema_metadata()['foreign_keys'].items()
+            for fk in fks if fk['foreign_table'] == table
+        ]
         
+        with self.connection(dict_cursor=False) as conn:
+            if not conn:
+                return {'success': False, 'error': 'No connection'}
+            
+            try:
+                with conn.cursor() as cur:
+                    dependencies = []
+                    for ref in refs:
+                        child = ref[0]
+                        child_col = ref[1]
+                        check = f"""
+                            SELECT COUNT(*) FROM {child}
+                            WHERE {child_col} IN (
+                                SELECT id FROM {table} WHERE {condition}
+                            )
+                        """
+                        cur.execute(check)
+                        cnt = cur.fetchone()[0]
+                        if cnt > 0:
+                            dependencies.append({'table': child, 'count': cnt})
+                    
+                    if dependencies:
+                        return {
+                            'success': False,
+                            'error': 'Есть зависимые записи',
+                            'dependencies': dependencies
+                        }
+                    
+                    cur.execute(f"DELETE FROM {table} WHERE {condition}")
+                    conn.commit()
+                    self.invalidate_counts(table)
+                    return {'success': True, 'affected_rows': cur.rowcount}
+                    
+            except Exception as e:
+                conn.rollback()
+                return {'success': False, 'error': str(e)}
+    
+    def drop_table(self, table):
+        # только пользовательские таблицы public: служебные (схема spzr) и
+        # произвольные имена не удаляются
+        if table not in self.get_tables():
+            return False
+        with self.connection(dict_cursor=False) as conn:
+            if not conn: return False
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+                    conn.commit()
+                    self.invalidate_schema()
+                    return True
+            except:
+                conn.rollback()
+                return False
+    
+    # ---------- Массовая загрузка измерений ----------
+    MEASUREMENT_FIELDS = ('product_id', 'supplier_id', 'characteristic_id', 'min_norm', 'max_norm', 'real_value')
+    
+    def _validate_measurement(self, rec):
+        """Привести запись к типам колонок; вернуть (row, None) или (None, ошибка)"""
+        if not isinstance(rec, dict):
+            return None, "Запись должна быть объектом"
+        missing = [f for f in self.MEASUREMENT_FIELDS if rec.get(f) in (None, '')]
+        if missing:
+            return None, f"Нет полей: {', '.join(missing)}"
         try:
-            with conn.cursor() as cur:
-                # Получаем внешние ключи
-                fk_query = """
-                    SELECT
-                        tc.table_name,
-                        kcu.column_name,
-                        ccu.table_name AS parent_table,
-                        ccu.column_name AS parent_column
-                    FROM information_schema.table_constraints tc
-                    JOIN information_schema.key_column_usage kcu
-                        ON tc.constraint_name = kcu.constraint_name
-                    JOIN information_schema.constraint_column_usage ccu
-                        ON ccu.constraint_name = tc.constraint_name
-                    WHERE tc.constraint_type = 'FOREIGN KEY'
-                    AND ccu.table_name = %s
-                """
-                cur.execute(fk_query, (table,))
-                refs = cur.fetchall()
-                
-                dependencies = []
-                for ref in refs:
-                    child = ref[0]
-                    child_col = ref[1]
-                    check = f"""
-                        SELECT COUNT(*) FROM {child}
-                        WHERE {child_col} IN (
-                            SELECT id FROM {table} WHERE {condition}
-                        )
-                    """
-                    cur.execute(check)
-                    cnt = cur.fetchone()[0]
-                    if cnt > 0:
-                        dependencies.append({'table': child, 'count': cnt})
-                
-                if dependencies:
-                    return {
-                        'success': False,
-                        'error': 'Есть зависимые записи',
-                        'dependencies': dependencies
-                    }
-                
-                cur.execute(f"DELETE FROM {table} WHERE {condition}")
+            row = [int(rec[f]) for f in self.MEASUREMENT_FIELDS[:3]]
+            row += [float(rec[f]) for f in self.MEASUREMENT_FIELDS[3:]]
+        except (TypeError, ValueError) as e:
+            return None, f"Неверное значение: {e}"
+        if any(math.isnan(v) or math.isinf(v) for v in row[3:]):
+            return None, "Неверное значение: NaN/inf"
+        if row[3] > row[4]:
+            return None, "min_norm больше max_norm"
+        date = rec.get('measurement_date')
+        if date in (None, ''):
+            row.append(None)
+        else:
+            try:
+                row.append(datetime.fromisoformat(str(date)).isoformat())
+            except ValueError:
+                return None, f"Неверная дата: {date}"
+        return row, None
+    
+    def bulk_insert_measurements(self, records, upsert=True):
+        """
+        Загрузка пачки измерений в product_characteristics одной транзакцией.
+        
+        Записи проверяются в Python, валидные грузятся через COPY FROM STDIN
+        во временную таблицу, затем одним INSERT ... SELECT с
+        ON CONFLICT (product_id, supplier_id, characteristic_id) DO UPDATE
+        (или DO NOTHING при upsert=False). Возвращает отчет по отклоненным строкам.
+        """
+        rejected = []
+        staged = {}
+        for row_no, rec in enumerate(records, start=1):
+            row, error = self._validate_measurement(rec)
+            if error:
+                rejected.append({'row': row_no, 'error': error})
+                continue
+            key = tuple(row[:3])
+            if key in staged:
+                rejected.append({'row': staged[key][0], 'error': f"Дубликат ключа, заменен строкой {row_no}"})
+            staged[key] = (row_no, row)
+        
+        result = {'total': len(records), 'inserted': 0, 'updated': 0, 'rejected': rejected}
+        if not staged:
+            return result
+        
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row_no, row in staged.values():
+            writer.writerow([row_no] + [r if r is not None else '' for r in row])
+        buf.seek(0)
+        
+        on_conflict = """
+            DO UPDATE SET
+                min_norm = EXCLUDED.min_norm,
+                max_norm = EXCLUDED.max_norm,
+                real_value = EXCLUDED.real_value,
+                measurement_date = EXCLUDED.measurement_date
+        """ if upsert else "DO NOTHING"
+        
+        with self.connection(dict_cursor=False) as conn:
+            if not conn:
+                raise ConnectionError("Нет соединения с БД")
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        CREATE TEMP TABLE measurements_staging (
+                            row_no INTEGER,
+                            product_id INTEGER,
+                            supplier_id INTEGER,
+                            characteristic_id INTEGER,
+                            min_norm FLOAT,
+                            max_norm FLOAT,
+                            real_value FLOAT,
+                            measurement_date TIMESTAMP
+                        ) ON COMMIT DROP
+                    """)
+                    cur.copy_expert("COPY measurements_staging FROM STDIN WITH (FORMAT csv)", buf)
+                    
+                    # Ссылки на несуществующие продукты / поставщиков / характеристики
+                    cur.execute("""
+                        SELECT s.row_no,
+                               p.id IS NULL, sp.id IS NULL, c.id IS NULL
+                        FROM measurements_staging s
+                        LEFT JOIN products p ON p.id = s.product_id
+                        LEFT JOIN suppliers sp ON sp.id = s.supplier_id
+                        LEFT JOIN characteristics c ON c.id = s.characteristic_id
+                        WHERE p.id IS NULL OR sp.id IS NULL OR c.id IS NULL
+                    """)
+                    for row_no, no_product, no_supplier, no_char in cur.fetchall():
+                        missing = [name for name, flag in (
+                            ('product_id', no_product),
+                            ('supplier_id', no_supplier),
+                            ('characteristic_id', no_char)
+                        ) if flag]
+                        rejected.append({'row': row_no, 'error': f"Нет ссылки: {', '.join(missing)}"})
+                    
+                    cur.execute(f"""
+                        INSERT INTO product_characteristics
+                            (product_id, supplier_id, characteristic_id,
+                             min_norm, max_norm, real_value, measurement_date)
+                        SELECT s.product_id, s.supplier_id, s.characteristic_id,
+                               s.min_norm, s.max_norm, s.real_value,
+                               COALESCE(s.measurement_date, NOW())
+                        FROM measurements_staging s
+                        WHERE EXISTS (SELECT 1 FROM products p WHERE p.id = s.product_id)
+                          AND EXISTS (SELECT 1 FROM suppliers sp WHERE sp.id = s.supplier_id)
+                          AND EXISTS (SELECT 1 FROM characteristics c WHERE c.id = s.characteristic_id)
+                        ON CONFLICT (product_id, supplier_id, characteristic_id) {on_conflict}
+                        RETURNING product_id, supplier_id, characteristic_id, (xmax = 0)
+                    """)
+                    written = cur.fetchall()
+                    result['inserted'] = sum(1 for r in written if r[3])
+                    result['updated'] = len(written) - result['inserted']
+                    
+                    if not upsert:
+                        done = {tuple(r[:3]) for r in written}
+                        failed = {r['row'] for r in rejected}
+                        for key, (row_no, _) in staged.items():
+                            if key not in done and row_no not in failed:
+                                rejected.append({'row': row_no, 'error': "Запись уже существует"})
                 conn.commit()
-                return {'success': True, 'affected_rows': cur.rowcount}
-                
-        except Exception as e:
-            conn.rollback()
-            return {'success': False, 'error': str(e)}
+            except Exception:
+                conn.rollback()
+                raise
+        
+        self.invalidate_counts('product_characteristics')
+        rejected.sort(key=lambda r: r['row'])
+        return result
+    
+    # ---------- Запросы конструктора: лимит, таймаут, отмена ----------
+    # Первое слово запроса после пробелов, комментариев и открывающих скобок
+    CURSOR_STATEMENT = re.compile(
+        r'(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/|\()*(SELECT|WITH|VALUES|TABLE)\b',
+        re.IGNORECASE | re.DOTALL
+    )
+    
+    @contextmanager
+    def _tracked(self, conn, query_id=None, timeout_ms=None):
+        """statement_timeout на транзакцию и регистрация соединения для cancel_query"""
+        if timeout_ms:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+        if query_id:
+            with self._running_lock:
+                self._running[query_id] = conn
+        try:
+            yield
         finally:
-            conn.close()
+            if query_id:
+                with self._running_lock:
+                    self._running.pop(query_id, None)
     
-    def drop_table(self, table):
-        conn = self.get_connection(dict_cursor=False)
-        if not conn: return False
+    def run_query(self, query, params=None, max_rows=1000, offset=0, timeout_ms=None, query_id=None):
+        """
+        Произвольный запрос с ограничением результата.
+        
+        SELECT-подобные запросы читаются серверным курсором: offset строк
+        пропускается на сервере (MOVE), клиенту передается max_rows + 1 строк —
+        лишняя только показывает, что есть продолжение. Запросы, которые нельзя
+        объявить курсором (изменяющий WITH, SELECT ... INTO, несколько команд),
+        и остальные выполняются обычным курсором; offset и max_rows применяются
+        и к ним. Ошибки БД (в т.ч. таймаут и отмена) пробрасываются.
+        Возвращает columns, rows, has_more, rowcount.
+        """
+        with self.connection() as conn:
+            if not conn:
+                raise ConnectionError("Нет соединения с БД")
+            try:
+                with self._tracked(conn, query_id, timeout_ms):
+                    cur = None
+                    # несколько команд через ';' — только обычным курсором (результат последней)
+                    if self.CURSOR_STATEMENT.match(query) and ';' not in query.strip().rstrip(';'):
+                        cur = self._declare_cursor(conn, query, params, max_rows + 1)
+                    if cur is None:
+                        cur = conn.cursor()
+                        cur.execute(query, params or None)
+                    with cur:
+                        # у серверного курсора description появляется после первого чтения
+                        if cur.name or cur.description:
+                            if cur.name or offset < cur.rowcount:
+                                if offset:
+                                    cur.scroll(offset)
+                                rows = cur.fetchmany(max_rows + 1)
+                            else:
+                                rows = []
+                            columns = [d[0] for d in cur.description]
+                        else:
+                            rows, columns = [], []
+                        rowcount = cur.rowcount
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return {
+            'columns': columns,
+            'rows': rows[:max_rows],
+            'has_more': len(rows) > max_rows,
+            'rowcount': rowcount
+        }
+    
+    @staticmethod
+    def _declare_cursor(conn, query, params, itersize):
+        """
+        Серверный курсор для запроса или None, если PostgreSQL не принимает
+        его в DECLARE (ошибка разбора откатывается до точки сохранения)
+        """
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT run_query")
+        cur = conn.cursor(name=f"query_{uuid.uuid4().hex}")
+        cur.itersize = itersize
         try:
-            with conn.cursor() as cur:
-                cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+            cur.execute(query, params or None)
+        except (psycopg2.ProgrammingError, psycopg2.NotSupportedError):
+            cur.close()
+            with conn.cursor() as c:
+                c.execute("ROLLBACK TO SAVEPOINT run_query")
+            return None
+        return cur
+    
+    def cancel_query(self, query_id):
+        """
+        Отменить выполняющийся запрос; False — запрос не найден.
+
+        Отмена идет по ключу сессии соединения (conn.cancel) и отправляется под
+        _running_lock: _tracked снимает регистрацию под той же блокировкой, поэтому
+        соединение не может вернуться в пул и выполнить чужой запрос до отмены
+        """
+        with self._running_lock:
+            conn = self._running.get(query_id)
+            if conn is None:
+                return False
+            try:
+                conn.cancel()
+            except psycopg2.Error as e:
+                print(f"Cancel error: {e}")
+                return False
+        return True
+    
+    def running_queries(self):
+        with self._running_lock:
+            return list(self._running)
+    
+    def stream_query(self, query, params=None, chunk_size=None, timeout_ms=None, query_id=None):
+        """
+        Генератор результата запроса порциями через именованный (серверный) курсор.
+        
+        Отдает пары (columns, rows), rows — список кортежей; в памяти
+        одновременно не больше chunk_size строк. Для пустого результата
+        отдается одна пара с пустым rows, чтобы были известны колонки.
+        timeout_ms и query_id — как в run_query.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        with self.connection(dict_cursor=False) as conn:
+            if not conn:
+                raise ConnectionError("Нет соединения с БД")
+            try:
+                with self._tracked(conn, query_id, timeout_ms), \
+                        conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+                    cur.itersize = chunk_size
+                    cur.execute(query, params or None)
+                    rows = cur.fetchmany(chunk_size)
+                    columns = [d[0] for d in cur.description]
+                    yield columns, rows
+                    while rows:
+                        rows = cur.fetchmany(chunk_size)
+                        if rows:
+                            yield columns, rows
                 conn.commit()
-                return True
-        except:
-            conn.rollback()
-            return False
-        finally:
-            conn.close()
+            except BaseException:
+                conn.rollback()
+                raise
+    
+    def format_stream(self, chunks, fmt):
+        """Порции (columns, rows) -> текстовые порции CSV, NDJSON или JSON-массива"""
+        header = fmt == 'csv'
+        first = True
+        if fmt == 'json':
+            yield '['
+        for columns, rows in chunks:
+            buf = io.StringIO()
+            if fmt == 'csv':
+                writer = csv.writer(buf)
+                if header:
+                    writer.writerow(columns)
+                    header = False
+                writer.writerows(rows)
+            elif fmt == 'json':
+                for row in rows:
+                    buf.write('\n' if first else ',\n')
+                    first = False
+                    buf.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+            else:
+                for row in rows:
+                    buf.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+                    buf.write('\n')
+            yield buf.getvalue()
+        if fmt == 'json':
+            yield '\n]\n'
+    
+    @staticmethod
+    def _xlsx_value(value):
+        """Значение ячейки для openpyxl: Excel не хранит часовые пояса, JSON/массивы — строкой"""
+        if value is None or isinstance(value, (str, int, float, Decimal, date, time_of_day)):
+            if isinstance(value, datetime) and value.tzinfo is not None:
+                return value.replace(tzinfo=None)
+            return value
+        return json.dumps(value, ensure_ascii=False, default=str)
+    
+    def export_query_to_xlsx(self, query, params=None, timeout_ms=None, query_id=None):
+        """
+        Результат запроса в XLSX: серверный курсор + openpyxl в режиме write_only.
+        Строки пишутся в лист по мере чтения, в памяти — одна порция.
+        """
+        d = self._timestamp_dir(self.dirs['exports'])
+        f = d / f"query_{datetime.now().strftime('%H%M%S')}.xlsx"
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('query')
+        try:
+            header = True
+            for columns, rows in self.stream_query(query, params, timeout_ms=timeout_ms, query_id=query_id):
+                if header:
+                    ws.append(columns)
+                    header = False
+                for row in rows:
+                    ws.append([self._xlsx_value(v) for v in row])
+            wb.save(str(f))
+        except BaseException:
+            f.unlink(missing_ok=True)
+            raise
+        return str(f), f.name
+    
+    def stream_table_export(self, table, fmt):
+        """Потоковый экспорт таблицы в CSV / NDJSON без загрузки всей таблицы в память"""
+        return self.format_stream(self.stream_query(f"SELECT * FROM {table}"), fmt)
+    
+    # ---------- Инкрементальный экспорт ----------
+    # Колонки-отметки по приоритету: время изменения, затем время добавления
+    WATERMARK_COLUMNS = ('updated_at', 'changed_at', 'modified_at', 'measurement_date', 'created_at')
+    WATERMARK_TYPES = ('timestamp without time zone', 'timestamp with time zone', 'date')
+    WATERMARK_DEFAULTS = ('now()', 'current_timestamp', 'clock_timestamp()', 'statement_timestamp()',
+                          'transaction_timestamp()', 'localtimestamp', 'current_date')
+    SEQUENCE_TYPES = ('smallint', 'integer', 'bigint')
+    
+    def get_watermark_columns(self, table):
+        """
+        Колонки для инкрементального экспорта, найденные по схеме (по приоритету):
+        временные отметки из WATERMARK_COLUMNS и другие с DEFAULT now(), затем
+        целочисленный первичный ключ с последовательностью (только новые строки).
+        """
+        columns = self.get_table_columns(table)
+        by_name = {c['column_name']: c for c in columns}
+        
+        def stamped(c):
+            default = (c['column_default'] or '').lower()
+            return any(d in default for d in self.WATERMARK_DEFAULTS)
+        
+        ordered = [by_name[name] for name in self.WATERMARK_COLUMNS if name in by_name]
+        ordered += [c for c in columns if c['column_name'] not in self.WATERMARK_COLUMNS and stamped(c)]
+        found = [
+            {'column': c['column_name'], 'kind': 'timestamp', 'type': c['data_type']}
+            for c in ordered if c['data_type'] in self.WATERMARK_TYPES
+        ]
+        
+        pk = self.get_schema_metadata()['primary_keys'].get(table, [])
+        if len(pk) == 1 and pk[0] in by_name:
+            c = by_name[pk[0]]
+            if c['data_type'] in self.SEQUENCE_TYPES and 'nextval(' in (c['column_default'] or ''):
+                found.append({'column': c['column_name'], 'kind': 'sequence', 'type': c['data_type']})
+        return found
+    
+    def _watermark_bound(self, table, mark):
+        """
+        Верхняя граница выгрузки: все строки ниже нее уже зафиксированы.
+        
+        timestamp — начало самой старой идущей транзакции (или now()): отметка
+        DEFAULT now() не меньше начала своей транзакции, поэтому незафиксированные
+        строки окажутся выше границы. sequence — max(id) + 1 под кратковременной
+        блокировкой SHARE, которая дожидается текущих записей в таблицу.
+        """
+        with self.connection(dict_cursor=False) as conn:
+            if not conn:
+                raise ConnectionError("Нет соединения с БД")
+            try:
+                with conn.cursor() as cur:
+                    if mark['kind'] == 'timestamp':
+                        cur.execute(f"""
+                            SELECT LEAST(now(), min(xact_start))::{mark['type']}
+                            FROM pg_stat_activity
+                            WHERE xact_start IS NOT NULL AND pid <> pg_backend_pid()
+                        """)
+                    else:
+                        cur.execute("SET LOCAL lock_timeout = %s", (self.watermark_lock_timeout_ms,))
+                        cur.execute(f"LOCK TABLE {table} IN SHARE MODE")
+                        cur.execute(f"SELECT COALESCE(max({mark['column']}), 0) + 1 FROM {table}")
+                    bound = cur.fetchone()[0]
+                conn.commit()
+                return bound
+            except BaseException:
+                conn.rollback()
+                raise
+    
+    def incremental_export_query(self, table, since=None, column=None):
+        """
+        Запрос инкрементального экспорта: строки с since <= отметка < watermark.
+        
+        Возвращает (info, query, params); info['watermark'] передается как since
+        в следующий раз — интервалы соседних выгрузок не пересекаются и не
+        оставляют пропусков. Без since выгружается все ниже границы (и строки
+        с пустой отметкой). Строки, которым отметку задали явно задним числом,
+        в уже выгруженный интервал не попадут.
+        """
+        marks = self.get_watermark_columns(table)
+        if not marks:
+            raise ValueError(f"В таблице {table} нет колонки-отметки (дата или id с последовательностью)")
+        if column is None:
+            mark = marks[0]
+        else:
+            mark = next((m for m in marks if m['column'] == column), None)
+            if mark is None:
+                raise ValueError(f"Колонка {column} не подходит для отметки; доступны: "
+                                 f"{', '.join(m['column'] for m in marks)}")
+        
+        if since is not None:
+            try:
+                since = int(since) if mark['kind'] == 'sequence' else datetime.fromisoformat(since).isoformat()
+            except ValueError:
+                raise ValueError(f"Некорректная отметка: {since}")
+        
+        bound = self._watermark_bound(table, mark)
+        col = mark['column']
+        if since is None:
+            where = f"{col} < %(bound)s OR {col} IS NULL"
+        else:
+            where = f"{col} >= %(since)s::{mark['type']} AND {col} < %(bound)s"
+        query = f"SELECT * FROM {table} WHERE {where} ORDER BY {col}"
+        info = {
+            'table': table,
+            'column': col,
+            'kind': mark['kind'],
+            'since': since,
+            'watermark': bound.isoformat() if hasattr(bound, 'isoformat') else bound
+        }
+        return info, query, {'since': since, 'bound': bound}
     
     # ---------- Экспорт ----------
     def export_table_to_excel(self, table):
@@ -294,59 +1684,494 @@ class Database:
         except Exception as e:
             return None, str(e)
     
-    # ---------- Backup / Restore ----------
-    def create_backup(self):
+    # ---------- Массовый экспорт через COPY ----------
+    def copy_table_to_file(self, table, path, compress=False):
+        """COPY ... TO STDOUT в CSV-файл (опционально gzip), без построения Python-объектов"""
+        started = time.monotonic()
+        opener = gzip.open if compress else open
+        with self.connection(dict_cursor=False) as conn:
+            if not conn:
+                raise ConnectionError("Нет соединения с БД")
+            try:
+                with conn.cursor() as cur, opener(path, 'wb') as fp:
+                    # COPY (SELECT ...) — работает и для представлений
+                    cur.copy_expert(f"COPY (SELECT * FROM {table}) TO STDOUT WITH (FORMAT csv, HEADER true)", fp)
+                    rows = cur.rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                Path(path).unlink(missing_ok=True)
+                raise
+        seconds = time.monotonic() - started
+        return {
+            'table': table,
+            'file': Path(path).name,
+            'rows': rows,
+            'bytes': Path(path).stat().st_size,
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(rows / seconds) if seconds > 0 else rows
+        }
+    
+    def export_table_to_csv(self, table, compress=False):
+        """Экспорт таблицы в CSV (.csv / .csv.gz) через COPY; возвращает (path, name, stats)"""
         try:
-            db = os.getenv('DB_NAME', 'clothing_warehouse')
-            user = os.getenv('DB_USER', 'postgres')
-            host = os.getenv('DB_HOST', 'postgres')
-            port = os.getenv('DB_PORT', '5432')
-            d = self._timestamp_dir(self.dirs['backups'])
-            f = d / f"backup_{db}_{datetime.now().strftime('%H%M%S')}.backup"
-            
-            cmd = [
-                self.pg_dump, '-h', host, '-U', user, '-p', port,
-                '-d', db, '-F', 'c', '-f', str(f)
-            ]
-            env = os.environ.copy()
-            env['PGPASSWORD'] = os.getenv('DB_PASSWORD', 'postgres')
-            
-            res = subprocess.run(cmd, env=env, capture_output=True, text=True)
-            if res.returncode == 0:
-                return True, str(f), None
-            return False, None, res.stderr
+            d = self._timestamp_dir(self.dirs['exports'])
+            ext = "csv.gz" if compress else "csv"
+            f = d / f"{table}_{datetime.now().strftime('%H%M%S')}.{ext}"
+            stats = self.copy_table_to_file(table, f, compress)
+            return str(f), f.name, stats
         except Exception as e:
-            return False, None, str(e)
+            return None, str(e), None
     
-    def restore_backup(self, backup_file):
-        """Восстановление из .backup файла"""
+    def export_tables_to_csv(self, tables, compress=False):
+        """Экспорт нескольких таблиц через COPY в один zip (+ manifest.json со статистикой)"""
         try:
-            db = os.getenv('DB_NAME', 'clothing_warehouse')
-            user = os.getenv('DB_USER', 'postgres')
-            host = os.getenv('DB_HOST', 'postgres')
-            port = os.getenv('DB_PORT', '5432')
-            
-            cmd = [
-                self.pg_restore, '-h', host, '-U', user, '-p', port,
-                '-d', db, '--clean', '--if-exists', backup_file
-            ]
-            env = os.environ.copy()
-            env['PGPASSWORD'] = os.getenv('DB_PASSWORD', 'postgres')
+            started = time.monotonic()
+            d = self._timestamp_dir(self.dirs['exports'], unique=True)
+            ext = "csv.gz" if compress else "csv"
+            table_stats = []
+            for t in tables:
+                table_stats.append(self.copy_table_to_file(t, d / f"{t}.{ext}", compress))
             
-            res = subprocess.run(cmd, env=env, capture_output=True, text=True)
-            if res.returncode == 0:
-                return True, "Восстановление из .backup выполнено"
+            # gzip-файлы уже сжаты — в архив кладем без повторного сжатия
+            return self._zip_export(d, table_stats, started, zipfile.ZIP_STORED if compress else zipfile.ZIP_DEFLATED)
+        except Exception as e:
+            return None, str(e), None
+    
+    def _zip_export(self, d, table_stats, started, compression):
+        """Файлы таблиц из d -> один zip + manifest.json со статистикой; возвращает (path, name, stats)"""
+        seconds = time.monotonic() - started
+        rows = sum(t['rows'] for t in table_stats)
+        stats = {
+            'tables': table_stats,
+            'rows': rows,
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(rows / seconds) if seconds > 0 else rows
+        }
+        
+        f = d / f"export_{datetime.now().strftime('%H%M%S')}.zip"
+        with zipfile.ZipFile(f, 'w', compression=compression) as zf:
+            for t in table_stats:
+                zf.write(d / t['file'], arcname=t['file'])
+                (d / t['file']).unlink()
+            zf.writestr("manifest.json", json.dumps(stats, ensure_ascii=False, indent=2))
+        return str(f), f.name, stats
+    
+    # ---------- Колоночный экспорт (Parquet / Arrow IPC) ----------
+    COLUMNAR_FORMATS = {'parquet': 'parquet', 'arrow': 'arrow'}
+    # Типы PostgreSQL (format_type без модификатора) -> типы Arrow
+    ARROW_TYPES = {
+        'smallint': pa.int16(),
+        'integer': pa.int32(),
+        'bigint': pa.int64(),
+        'real': pa.float32(),
+        'double precision': pa.float64(),
+        'boolean': pa.bool_(),
+        'text': pa.string(),
+        'character varying': pa.string(),
+        'character': pa.string(),
+        'name': pa.string(),
+        'uuid': pa.string(),
+        'date': pa.date32(),
+        'time without time zone': pa.time64('us'),
+        'timestamp without time zone': pa.timestamp('us'),
+        'timestamp with time zone': pa.timestamp('us', tz='UTC'),
+        'interval': pa.duration('us'),
+        'bytea': pa.binary()
+    }
+    NUMERIC_TYPE = re.compile(r'numeric\((\d+),(\d+)\)')
+    
+    @classmethod
+    def _arrow_type(cls, data_type, full_type=None):
+        """
+        Тип Arrow для колонки: numeric(p,s) -> decimal128, массивы -> list,
+        numeric без точности, json и прочие типы -> строка
+        """
+        if data_type.endswith('[]'):
+            base = data_type[:-2]
+            if base in cls.ARROW_TYPES or base == 'numeric':
+                return pa.list_(cls._arrow_type(base, (full_type or '')[:-2]))
+            return pa.string()
+        if data_type == 'numeric':
+            m = cls.NUMERIC_TYPE.fullmatch(full_type or '')
+            if m and int(m.group(1)) <= 38:
+                return pa.decimal128(int(m.group(1)), int(m.group(2)))
+            return pa.string()
+        return cls.ARROW_TYPES.get(data_type, pa.string())
+    
+    @staticmethod
+    def _arrow_text(value):
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False, default=str)
+        return str(value)
+    
+    def arrow_schema(self, table):
+        """Схема Arrow таблицы по get_table_columns (nullable — как в БД)"""
+        return pa.schema([
+            pa.field(c['column_name'], self._arrow_type(c['data_type'], c.get('full_type')),
+                     nullable=c.get('is_nullable', 'YES') == 'YES')
+            for c in self.get_table_columns(table)
+        ])
+    
+    def write_table_columnar(self, table, path, fmt='parquet'):
+        """
+        Таблица в Parquet / Arrow IPC через серверный курсор: каждая порция
+        из row_group_size строк пишется отдельной row group (record batch),
+        в памяти — одна порция. Возвращает статистику как copy_table_to_file.
+        """
+        started = time.monotonic()
+        schema = self.arrow_schema(table)
+        if not len(schema):
+            raise ValueError(f"Таблица {table} не найдена")
+        # значения, которые Arrow не примет как есть: json/прочее -> строка, memoryview -> bytes
+        convert = [
+            self._arrow_text if field.type == pa.string()
+            else (lambda v: None if v is None else bytes(v)) if field.type == pa.binary()
+            else None
+            for field in schema
+        ]
+        rows = groups = 0
+        
+        if fmt == 'parquet':
+            writer = pq.ParquetWriter(path, schema, compression=self.parquet_compression)
+        else:
+            writer = pa.ipc.new_file(str(path), schema)
+        try:
+            for _, chunk in self.stream_query(f"SELECT * FROM {table}", chunk_size=self.row_group_size):
+                if not chunk:
+                    continue
+                values = list(zip(*chunk))
+                arrays = [
+                    pa.array([fn(v) for v in col] if fn else col, type=field.type)
+                    for col, field, fn in zip(values, schema, convert)
+                ]
+                batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+                if fmt == 'parquet':
+                    writer.write_batch(batch, row_group_size=len(chunk))
+                else:
+                    writer.write_batch(batch)
+                rows += len(chunk)
+                groups += 1
+            writer.close()
+        except Exception:
+            writer.close()
+            Path(path).unlink(missing_ok=True)
+            raise
+        
+        seconds = time.monotonic() - started
+        return {
+            'table': table,
+            'file': Path(path).name,
+            'rows': rows,
+            'row_groups': groups,
+            'bytes': Path(path).stat().st_size,
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(rows / seconds) if seconds > 0 else rows
+        }
+    
+    def export_table_to_columnar(self, table, fmt='parquet'):
+        """Экспорт таблицы в .parquet / .arrow; возвращает (path, name, stats)"""
+        try:
+            d = self._timestamp_dir(self.dirs['exports'])
+            f = d / f"{table}_{datetime.now().strftime('%H%M%S')}.{self.COLUMNAR_FORMATS[fmt]}"
+            stats = self.write_table_columnar(table, f, fmt)
+            return str(f), f.name, stats
+        except Exception as e:
+            return None, str(e), None
+    
+    def export_tables_to_columnar(self, tables, fmt='parquet'):
+        """Экспорт нескольких таблиц в Parquet / Arrow IPC в один zip (+ manifest.json)"""
+        try:
+            started = time.monotonic()
+            d = self._timestamp_dir(self.dirs['exports'], unique=True)
+            ext = self.COLUMNAR_FORMATS[fmt]
+            table_stats = [self.write_table_columnar(t, d / f"{t}.{ext}", fmt) for t in tables]
+            # Parquet уже сжат; Arrow IPC пишется без сжатия
+            return self._zip_export(d, table_stats, started,
+                                    zipfile.ZIP_STORED if fmt == 'parquet' else zipfile.ZIP_DEFLATED)
+        except Exception as e:
+            return None, str(e), None
+    
+    # ---------- Backup / Restore ----------
+    BACKUP_FORMATS = {'custom': 'c', 'directory': 'd'}
+    # Строки pg_dump -v: начало выгрузки таблицы и (при -j) завершение
+    DUMP_TABLE_STARTED = re.compile(r'dumping contents of table "([^"]+)"')
+    DUMP_TABLE_FINISHED = re.compile(r'finished item \d+ TABLE DATA (\S+)')
+    
+    def _run_tool(self, cmd, on_line=None, tick=None):
+        """
+        Запустить pg_dump / pg_restore / psql без буферизации вывода в памяти.
+        
+        Строки stderr передаются в on_line по мере появления, tick() вызывается
+        раз в секунду до завершения. Возвращает (код возврата, строки stderr).
+        """
+        env = os.environ.copy()
+        env['PGPASSWORD'] = os.getenv('DB_PASSWORD', 'postgres')
+        log = []
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        
+        def read_log():
+            for line in proc.stderr:
+                line = line.rstrip()
+                log.append(line)
+                if on_line:
+                    on_line(line)
+        
+        reader = threading.Thread(target=read_log, daemon=True)
+        reader.start()
+        while True:
+            try:
+                proc.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                if tick:
+                    tick()
+        reader.join()
+        return proc.returncode, log
+    
+    @staticmethod
+    def _tool_error(returncode, log):
+        errors = [line for line in log if 'error' in line.lower()]
+        return '\n'.join(errors or log[-5:]) or f"Код завершения {returncode}"
+    
+    @staticmethod
+    def _path_size(path):
+        path = Path(path)
+        if path.is_dir():
+            return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+        return path.stat().st_size if path.exists() else 0
+    
+    def run_backup(self, format='custom', jobs=1, compress=None, progress=None):
+        """
+        Полный бэкап через pg_dump.
+        
+        format='custom' — один .backup файл (-F c, всегда в один поток);
+        format='directory' — каталог (-F d), таблицы выгружаются в jobs потоков (-j).
+        compress — уровень сжатия 0-9 (-Z), None — по умолчанию pg_dump.
+        progress(**поля) получает фазу, число выгруженных таблиц и размер на диске.
+        Возвращает статистику (путь, размер, длительность) и пишет ее в <имя>.json рядом.
+        """
+        if format not in self.BACKUP_FORMATS:
+            raise ValueError(f"Неизвестный формат бэкапа: {format}")
+        if jobs > 1 and format != 'directory':
+            raise ValueError("Параллельная выгрузка (-j) доступна только для формата directory")
+        if compress is not None and not 0 <= compress <= 9:
+            raise ValueError("Уровень сжатия должен быть от 0 до 9")
+        progress = progress or (lambda **fields: None)
+        
+        db = os.getenv('DB_NAME', 'clothing_warehouse')
+        user = os.getenv('DB_USER', 'postgres')
+        host = os.getenv('DB_HOST', 'postgres')
+        port = os.getenv('DB_PORT', '5432')
+        d = self._timestamp_dir(self.dirs['backups'])
+        name = f"backup_{db}_{datetime.now().strftime('%H%M%S')}"
+        f = d / (name if format == 'directory' else f"{name}.backup")
+        
+        cmd = [
+            self.pg_dump, '-h', host, '-U', user, '-p', port,
+            '-d', db, '-F', self.BACKUP_FORMATS[format], '-f', str(f), '-v'
+        ]
+        if jobs > 1:
+            cmd += ['-j', str(jobs)]
+        if compress is not None:
+            cmd += ['-Z', str(compress)]
+        
+        total = self.execute_query("""
+            SELECT count(*) AS n FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+              AND n.nspname NOT LIKE 'pg_toast%%'
+        """)
+        state = {'started': [], 'finished': set()}
+        
+        def report():
+            # без -j pg_dump не пишет "finished item": таблица готова, когда началась следующая
+            started, finished = state['started'], state['finished']
+            progress(
+                phase='data' if started else 'schema',
+                current=started[-1] if started else None,
+                tables_dumped=len(finished) if finished else max(0, len(started) - 1),
+                bytes=self._path_size(f),
+                seconds=round(time.monotonic() - t0, 3)
+            )
+        
+        def on_line(line):
+            m = self.DUMP_TABLE_STARTED.search(line)
+            if m:
+                state['started'].append(m.group(1))
+                report()
+            m = self.DUMP_TABLE_FINISHED.search(line)
+            if m:
+                state['finished'].add(m.group(1))
+                report()
+        
+        t0 = time.monotonic()
+        progress(phase='schema', format=format, jobs=jobs, compress=compress,
+                 tables_total=total[0]['n'] if total else None, tables_dumped=0, bytes=0)
+        returncode, log = self._run_tool(cmd, on_line, report)
+        seconds = time.monotonic() - t0
+        
+        if returncode != 0:
+            if f.is_dir():
+                shutil.rmtree(f, ignore_errors=True)
+            else:
+                f.unlink(missing_ok=True)
+            raise RuntimeError(self._tool_error(returncode, log))
+        
+        size = self._path_size(f)
+        stats = {
+            'path': str(f),
+            'file': f.name,
+            'format': format,
+            'jobs': jobs,
+            'compress': compress,
+            'tables': len(state['started']),
+            'bytes': size,
+            'seconds': round(seconds, 3),
+            'bytes_per_sec': round(size / seconds) if seconds > 0 else size,
+            'created_at': datetime.now().isoformat()
+        }
+        with open(d / f"{name}.json", 'w', encoding='utf-8') as fp:
+            json.dump(stats, fp, ensure_ascii=False, indent=2)
+        progress(phase='done', tables_dumped=stats['tables'], bytes=size, seconds=stats['seconds'])
+        return stats
+    
+    def create_backup(self, format='custom', jobs=1, compress=None, progress=None):
+        try:
+            stats = self.run_backup(format, jobs, compress, progress)
+            return True, stats['path'], None
+        except Exception as e:
+            return False, None, str(e)
+    
+    def list_backups(self):
+        """Бэкапы со статистикой (размер, длительность, формат) — новые первыми"""
+        backups = []
+        for manifest in self.dirs['backups'].glob("*/backup_*.json"):
+            try:
+                with open(manifest, encoding='utf-8') as fp:
+                    stats = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            if Path(stats.get('path', '')).exists():
+                backups.append(stats)
+        return sorted(backups, key=lambda b: b.get('created_at', ''), reverse=True)
+    
+    # Строки pg_restore -v: шаг восстановления (без -j) и элемент TOC (с -j)
+    RESTORE_STEP = re.compile(r'^pg_restore: (creating|executing|processing data for) ')
+    RESTORE_ITEM = re.compile(r'^pg_restore: (?:processing|finished) item (\d+) ')
+    RESTORE_TABLE = re.compile(r'processing data for table "([^"]+)"')
+    
+    @staticmethod
+    def archive_format(path):
+        """Формат архива pg_dump: custom, directory, tar или None (не архив)"""
+        path = Path(path)
+        if path.is_dir():
+            return 'directory' if (path / 'toc.dat').exists() else None
+        with open(path, 'rb') as fp:
+            header = fp.read(512)
+        if header.startswith(b'PGDMP'):
+            return 'custom'
+        if header[257:262] == b'ustar':
+            return 'tar'
+        return None
+    
+    def run_restore(self, backup_file, jobs=1, progress=None):
+        """
+        Восстановление через pg_restore --clean --if-exists.
+        
+        Для форматов custom и directory данные и индексы восстанавливаются
+        в jobs потоков (-j); tar поддерживает только один поток.
+        progress(**поля) получает число обработанных элементов TOC и текущую таблицу.
+        """
+        format = self.archive_format(backup_file)
+        if format is None:
+            raise ValueError("Файл не является архивом pg_dump")
+        if format == 'tar':
+            jobs = 1
+        progress = progress or (lambda **fields: None)
+        
+        db = os.getenv('DB_NAME', 'clothing_warehouse')
+        user = os.getenv('DB_USER', 'postgres')
+        host = os.getenv('DB_HOST', 'postgres')
+        port = os.getenv('DB_PORT', '5432')
+        
+        # Число элементов TOC — знаменатель прогресса
+        listing = subprocess.run([self.pg_restore, '-l', str(backup_file)], capture_output=True, text=True)
+        total = sum(1 for line in listing.stdout.splitlines() if line and not line.startswith(';'))
+        
+        cmd = [
+            self.pg_restore, '-h', host, '-U', user, '-p', port,
+            '-d', db, '--clean', '--if-exists', '-v'
+        ]
+        if jobs > 1:
+            cmd += ['-j', str(jobs)]
+        cmd.append(str(backup_file))
+        
+        state = {'steps': 0, 'items': set(), 'table': None}
+        t0 = time.monotonic()
+        
+        def report():
+            progress(
+                phase='restore',
+                items_done=min(total, len(state['items']) or state['steps']),
+                current=state['table'],
+                seconds=round(time.monotonic() - t0, 3)
+            )
+        
+        def on_line(line):
+            m = self.RESTORE_ITEM.search(line)
+            if m:
+                state['items'].add(m.group(1))
+            elif self.RESTORE_STEP.search(line):
+                state['steps'] += 1
+            else:
+                return
+            m = self.RESTORE_TABLE.search(line)
+            if m:
+                state['table'] = m.group(1)
+            report()
+        
+        progress(phase='restore', format=format, jobs=jobs, items_total=total, items_done=0)
+        returncode, log = self._run_tool(cmd, on_line, report)
+        self.invalidate_schema()
+        seconds = round(time.monotonic() - t0, 3)
+        
+        message = "Восстановление из .backup выполнено"
+        if returncode != 0:
             # Игнорируем ошибку transaction_timeout
-            if "transaction_timeout" in res.stderr:
-                return True, "Восстановление с предупреждениями"
-            return False, res.stderr
+            if not any("transaction_timeout" in line for line in log):
+                raise RuntimeError(self._tool_error(returncode, log))
+            message = "Восстановление с предупреждениями"
+        # --clean пересоздает product_characteristics: триггеры сводки качества
+        # из старого дампа могут отсутствовать, а сама сводка — устареть
+        if 'product_characteristics' in self.get_tables():
+            self.ensure_quality_scores()
+        progress(phase='done', items_done=total, seconds=seconds)
+        return {
+            'message': message,
+            'file': Path(backup_file).name,
+            'format': format,
+            'jobs': jobs,
+            'items': total,
+            'seconds': seconds
+        }
+    
+    def restore_backup(self, backup_file, jobs=1, progress=None):
+        """Восстановление из .backup файла (или каталога бэкапа)"""
+        try:
+            return True, self.run_restore(backup_file, jobs, progress)['message']
         except Exception as e:
             return False, str(e)
     
-    def restore_from_sql(self, sql_file):
-        """Восстановление из SQL файла (например init.sql)"""
+    def restore_from_sql(self, sql_file, progress=None):
+        """Восстановление из SQL файла (например init.sql); сводка качества создается заново"""
         try:
-            return self.execute_sql_file(sql_file)
+            success, message = self.execute_sql_file(sql_file, progress)
+            if success and 'product_characteristics' in self.get_tables():
+                self.ensure_quality_scores()
+            return success, message
         except Exception as e:
             return False, str(e)
     
@@ -372,48 +2197,79 @@ class Database:
         except Exception as e:
             return False, None, str(e)
     
-    def archive_tables(self, tables):
+    def _archive_table(self, table, arch_dir, progress):
+        """Бэкап + Excel + JSON одной таблицы; данные читаются один раз"""
+        if table not in self.get_tables():
+            raise ValueError("таблица не найдена")
+        progress(table, status='running', phase='backup')
+        ok, bf, err = self.create_table_backup(table, arch_dir)
+        if not ok:
+            raise RuntimeError(f"ошибка backup - {err}")
+        
+        progress(table, phase='fetch')
+        data = self.get_table_data(table)
+        rows = len(data) if data else 0
+        
+        progress(table, phase='excel', rows_archived=rows)
+        ef = arch_dir / f"{table}_{datetime.now().strftime('%H%M%S')}.xlsx"
+        if data:
+            pd.DataFrame(data).to_excel(str(ef), index=False)
+        
+        progress(table, phase='json')
+        jf = arch_dir / f"{table}_{datetime.now().strftime('%H%M%S')}.json"
+        with open(jf, 'w', encoding='utf-8') as fp:
+            json.dump(data, fp, ensure_ascii=False, indent=2, default=str)
+        
+        return {
+            'table': table,
+            'rows_archived': rows,
+            'backup_file': os.path.basename(bf),
+            'excel_file': ef.name,
+            'json_file': jf.name,
+            'status': 'success'
+        }
+    
+    def archive_tables(self, tables, progress=None):
+        """
+        Архивация: бэкап (pg_dump -t) + Excel + JSON, затем DROP.
+        
+        Выгрузки идут параллельно (archive_workers потоков). Удаляются таблицы
+        после всех выгрузок, по порядку и только выгруженные без ошибок:
+        DROP ... CASCADE снимает FK соседних таблиц, которые еще может читать pg_dump.
+        progress(table, **поля) получает статус и фазу каждой таблицы.
+        """
+        progress = progress or (lambda table, **fields: None)
         try:
             arch_dir = self._timestamp_dir(self.dirs['archives'])
+            archived = {}
+            errors = {}
+            
+            workers = max(1, min(self.archive_workers, len(tables)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive') as pool:
+                futures = {pool.submit(self._archive_table, t, arch_dir, progress): t for t in tables}
+                for future in as_completed(futures):
+                    t = futures[future]
+                    try:
+                        archived[t] = future.result()
+                        progress(t, phase='exported')
+                    except Exception as e:
+                        errors[t] = str(e)
+                        progress(t, status='failed', phase=None, error=str(e))
+            
             results = []
             success_count = 0
-            
             for t in tables:
-                try:
-                    # 1. Backup
-                    ok, bf, err = self.create_table_backup(t, arch_dir)
-                    if not ok:
-                        results.append(f"Таблица {t}: ошибка backup - {err}")
-                        continue
-                    
-                    # 2. Excel
-                    ef = arch_dir / f"{t}_{datetime.now().strftime('%H%M%S')}.xlsx"
-                    data = self.get_table_data(t)
-                    rows = len(data) if data else 0
-                    if data:
-                        pd.DataFrame(data).to_excel(str(ef), index=False)
-                    
-                    # 3. JSON
-                    jf = arch_dir / f"{t}_{datetime.now().strftime('%H%M%S')}.json"
-                    with open(jf, 'w', encoding='utf-8') as fp:
-                        json.dump(data, fp, ensure_ascii=False, indent=2, default=str)
-                    
-                    # 4. Drop
-                    if self.drop_table(t):
-                        success_count += 1
-                        results.append({
-                            'table': t,
-                            'rows_archived': rows,
-                            'backup_file': os.path.basename(bf),
-                            'excel_file': ef.name,
-                            'json_file': jf.name,
-                            'status': 'success'
-                        })
-                    else:
-                        results.append(f"Таблица {t}: не удалось удалить")
-                        
-                except Exception as e:
-                    results.append(f"Таблица {t}: {str(e)}")
+                if t in errors:
+                    results.append(f"Таблица {t}: {errors[t]}")
+                    continue
+                progress(t, phase='drop')
+                if self.drop_table(t):
+                    success_count += 1
+                    results.append(archived[t])
+                    progress(t, status='done', phase=None)
+                else:
+                    results.append(f"Таблица {t}: не удалось удалить")
+                    progress(t, status='failed', phase=None, error="не удалось удалить")
             
             return True, {
                 'message': f"Архивация: {success_count}/{len(tables)}",
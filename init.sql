@@ -174,6 +174,15 @@ CREATE TABLE product_characteristics (
     UNIQUE(product_id, supplier_id, characteristic_id)
 );
 
+-- Индексы под запросы приложения (набор совпадает с Database.MANAGED_INDEXES);
+-- доступ по product_id покрывает UNIQUE выше
+CREATE INDEX idx_pc_characteristic ON product_characteristics (characteristic_id) INCLUDE (real_value, min_norm, max_norm);
+CREATE INDEX idx_pc_supplier_product ON product_characteristics (supplier_id, product_id);
+
+-- ============ СВОДКА КАЧЕСТВА (quality_scores) ============
+-- Таблицы сводки, функции и триггеры создает Database.ensure_quality_scores()
+-- (models.init_db при старте приложения) и пересчитывает все группы
+
 -- ============ 5. ЗАПОЛНЕНИЕ ХАРАКТЕРИСТИК ДЛЯ ВСЕХ ПРОДУКТОВ ============
 
 -- Функция для получения ID
@@ -0,0 +1,144 @@
+"""
+Фоновые задачи сервиса (архивация, бэкап, восстановление).
+
+Задача выполняется в отдельном потоке и сообщает прогресс через update()
+(общие поля) и update_item() (по элементам — таблицам, файлам). Статус
+читается через JobManager.get(job_id).to_dict() из HTTP-обработчика.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """Состояние одной фоновой задачи; методы потокобезопасны"""
+
+    def __init__(self, kind, items=()):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = PENDING
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = {}
+        self.items = OrderedDict((name, {'status': PENDING}) for name in items)
+        self.result = None
+        self.error = None
+        self._started = None
+        self._ended = None
+        self._lock = threading.Lock()
+
+    def update(self, **fields):
+        """Обновить общие поля прогресса (фаза, байты, проценты)"""
+        with self._lock:
+            self.progress.update(fields)
+
+    def update_item(self, name, **fields):
+        """Обновить прогресс элемента (status, rows, файлы, ошибка)"""
+        with self._lock:
+            self.items.setdefault(name, {'status': PENDING}).update(fields)
+
+    def _start(self):
+        with self._lock:
+            self.status = RUNNING
+            self.started_at = datetime.now()
+            self._started = time.monotonic()
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            self.status = FAILED if error is not None else DONE
+            self.result = result
+            self.error = error
+            self.finished_at = datetime.now()
+            self._ended = time.monotonic()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self):
+        with self._lock:
+            items = {name: dict(item) for name, item in self.items.items()}
+            done = sum(1 for item in items.values() if item['status'] in (DONE, FAILED))
+            seconds = None
+            if self._started is not None:
+                seconds = round((self._ended or time.monotonic()) - self._started, 3)
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'created_at': self.created_at.isoformat(),
+                'started_at': self.started_at.isoformat() if self.started_at else None,
+                'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+                'seconds': seconds,
+                'progress': dict(self.progress),
+                'items': items,
+                'items_done': done,
+                'items_total': len(items),
+                'result': self.result,
+                'error': self.error
+            }
+
+
+class JobManager:
+    """
+    Очередь фоновых задач.
+
+    max_running — сколько задач выполняется одновременно (остальные ждут
+    в статусе pending); keep — сколько завершенных задач хранить для опроса.
+    """
+
+    def __init__(self, max_running=2, keep=50):
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=max_running, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, func, *args, items=(), **kwargs):
+        """
+        Запустить func(job, *args, **kwargs) в фоне.
+
+        Возвращаемое значение становится job.result; исключение переводит
+        задачу в failed с текстом ошибки.
+        """
+        job = Job(kind, items)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        job._start()
+        try:
+            result = func(job, *args, **kwargs)
+        except Exception as e:
+            print(f"Job {job.kind} error: {e}")
+            job._finish(error=str(e))
+        else:
+            job._finish(result=result)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self, kind=None):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.to_dict() for job in reversed(jobs) if kind is None or job.kind == kind]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,17 +1,28 @@
 from fastapi import FastAPI, Request, Form, Depends, HTTPException, File, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Optional
 import os
+import csv
+import io
 import json
-import math
+import re
 from datetime import datetime
+from itertools import chain
+import shutil
 import tempfile
+import uuid
 from pathlib import Path
 
+import numpy as np
+
 from database import Database
+from cache import ResultCache
+from jobs import JobManager
+from scoring import ScoringEngine
+import spzr
 
 app = FastAPI(title="Склад одежды - Информационная система", version="2.0.0")
 
@@ -35,42 +46,67 @@ templates = Jinja2Templates(directory="templates")
 # Глобальный экземпляр БД
 db = Database()
 
-# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
+# Кэш результатов СППР (инвалидируется при записи в таблицы-источники)
+SPZR_TABLES = ('product_characteristics', 'products', 'suppliers', 'characteristics')
+spzr_cache = ResultCache(
+    maxsize=int(os.getenv('SPZR_CACHE_SIZE', '256')),
+    ttl=float(os.getenv('SPZR_CACHE_TTL', '300'))
+)
 
-def calculate_gradations(x, xmin, xmax, dx):
-    """
-    Правильный расчет градаций по методичке (стр. 35)
-    
-    n = 2, если значение в норме
-    n = (x - xmax)/Δx + 1, если x > xmax
-    n = (xmin - x)/Δx + 1, если x < xmin
-    
-    Важно: используем math.ceil для округления вверх
-    """
-    if xmin <= x <= xmax:
-        return 2
-    elif x > xmax:
-        # Отклонение вверх
-        diff = x - xmax
-        n = math.ceil(diff / dx) + 1
-        return max(2, min(n, 100))
-    else:  # x < xmin
-        # Отклонение вниз
-        diff = xmin - x
-        n = math.ceil(diff / dx) + 1
-        return max(2, min(n, 100))
+# analyze-all: состояние по Δx, дописываемое по журналу изменений quality_changes
+scoring_engine = ScoringEngine(
+    db,
+    max_deltas=int(os.getenv('SCORING_MAX_DELTAS', '8')),
+    ttl=float(os.getenv('SCORING_TTL', '600')),
+    retention=db.quality_changes_retention
+)
+
+def invalidate_spzr(table=None):
+    """Сбросить кэши СППР, зависящие от таблицы (или все)"""
+    spzr_cache.invalidate(table)
+    scoring_engine.invalidate(table)
+
+# Фоновые задачи сервиса (архивация, бэкап, восстановление); статус — /api/service/jobs/{job_id}
+jobs = JobManager(
+    max_running=int(os.getenv('JOB_WORKERS', '2')),
+    keep=int(os.getenv('JOB_HISTORY', '50'))
+)
+
+@app.on_event("shutdown")
+def close_db_pool():
+    jobs.shutdown()
+    db.close()
+
+# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
 # ==================== ГЛАВНАЯ ====================
+# Режим счетчиков строк на главной: exact (кэш COUNT(*)) или estimate (статистика PostgreSQL)
+COUNT_MODES = ("exact", "estimate")
+HOME_COUNTS_MODE = os.getenv("HOME_COUNTS_MODE", "exact")
+
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    tables = db.get_tables()
-    table_counts = {t: db.get_table_count(t) for t in tables}
+async def home(request: Request, counts: str = HOME_COUNTS_MODE):
+    counts_mode = counts if counts in COUNT_MODES else HOME_COUNTS_MODE
+    tables = await db.run(db.get_tables)
+    table_counts = await db.run(db.get_table_counts, tables, counts_mode)
     return templates.TemplateResponse("index.html", {
         "request": request,
         "tables": tables,
-        "table_counts": table_counts
+        "table_counts": table_counts,
+        "counts_mode": counts_mode
     })
 
+@app.get("/api/tables/counts")
+async def get_table_counts(mode: str = "exact"):
+    """Число строк во всех таблицах одним запросом (exact / estimate)"""
+    if mode not in COUNT_MODES:
+        return {"success": False, "error": "Неверный режим"}
+    return {
+        "success": True,
+        "mode": mode,
+        "counts": await db.run(db.get_table_counts, None, mode)
+    }
+
 # ==================== ДОКУМЕНТАЦИЯ ====================
 @app.get("/spzr/docs", response_class=HTMLResponse)
 async def spzr_docs(request: Request):
@@ -86,44 +122,22 @@ async def schema_view(request: Request):
         "request": request
     })
 
-@app.get("/api/schema/tables")
-async def get_schema_tables():
+def load_schema_tables():
     """Получить информацию о таблицах для схемы"""
-    tables = db.get_tables()
+    meta = db.get_schema_metadata()
     result = []
     
-    for table in tables:
-        # Получаем колонки
-        columns = db.get_table_columns(table) or []
-        
-        # Получаем первичные ключи
-        pk_query = """
-            SELECT kcu.column_name
-            FROM information_schema.table_constraints tc
-            JOIN information_schema.key_column_usage kcu
-                ON tc.constraint_name = kcu.constraint_name
-            WHERE tc.constraint_type = 'PRIMARY KEY'
-                AND tc.table_name = %s
-        """
-        pk_columns = db.execute_query(pk_query, (table,)) or []
-        pk_set = {r['column_name'] for r in pk_columns}
-        
-        # Получаем внешние ключи
-        fk_query = """
-            SELECT
-                kcu.column_name,
-                ccu.table_name AS foreign_table_name,
-                ccu.column_name AS foreign_column_name
-            FROM information_schema.table_constraints tc
-            JOIN information_schema.key_column_usage kcu
-                ON tc.constraint_name = kcu.constraint_name
-            JOIN information_schema.constraint_column_usage ccu
-                ON ccu.constraint_name = tc.constraint_name
-            WHERE tc.constraint_type = 'FOREIGN KEY'
-                AND tc.table_name = %s
-        """
-        fk_columns = db.execute_query(fk_query, (table,)) or []
-        fk_set = {r['column_name'] for r in fk_columns}
+    for table in meta['tables']:
+        columns = meta['columns'][table]
+        pk_set = set(meta['primary_keys'].get(table, []))
+        fk_columns = meta['foreign_keys'].get(table, [])
+        fk_info = {}
+        for fk in fk_columns:
+            fk_info.setdefault(fk['column_name'], {
+                'column_name': fk['column_name'],
+                'foreign_table_name': fk['foreign_table'],
+                'foreign_column_name': fk['foreign_column']
+            })
         
         # Формируем список колонок с дополнительной информацией
         columns_info = []
@@ -132,12 +146,9 @@ async def get_schema_tables():
                 'column_name': col['column_name'],
                 'data_type': col['data_type'],
                 'is_primary_key': col['column_name'] in pk_set,
-                'is_foreign_key': col['column_name'] in fk_set,
+                'is_foreign_key': col['column_name'] in fk_info,
                 'is_nullable': col['is_nullable'],
-                'foreign_key_info': next(
-                    (r for r in fk_columns if r['column_name'] == col['column_name']),
-                    None
-                )
+                'foreign_key_info': fk_info.get(col['column_name'])
             })
         
         result.append({
@@ -147,98 +158,47 @@ async def get_schema_tables():
     
     return JSONResponse(content=result)
 
+@app.get("/api/schema/tables")
+async def get_schema_tables():
+    """Получить информацию о таблицах для схемы"""
+    return await db.run(load_schema_tables)
+
 @app.get("/api/schema/relationships")
 async def get_relationships():
     """Получить все связи между таблицами"""
-    query = """
-        SELECT
-            tc.table_name AS from_table,
-            kcu.column_name AS from_column,
-            ccu.table_name AS to_table,
-            ccu.column_name AS to_column,
-            rc.update_rule,
-            rc.delete_rule
-        FROM information_schema.table_constraints tc
-        JOIN information_schema.key_column_usage kcu
-            ON tc.constraint_name = kcu.constraint_name
-        JOIN information_schema.constraint_column_usage ccu
-            ON ccu.constraint_name = tc.constraint_name
-        LEFT JOIN information_schema.referential_constraints rc
-            ON rc.constraint_name = tc.constraint_name
-        WHERE tc.constraint_type = 'FOREIGN KEY'
-        ORDER BY tc.table_name, kcu.ordinal_position
-    """
-    relationships = db.execute_query(query) or []
+    meta = await db.run(db.get_schema_metadata)
     
     result = []
-    for rel in relationships:
-        result.append({
-            'from_table': rel['from_table'],
-            'from_column': rel['from_column'],
-            'to_table': rel['to_table'],
-            'to_column': rel['to_column'],
-            'update_rule': rel['update_rule'],
-            'delete_rule': rel['delete_rule']
-        })
+    for table in sorted(meta['foreign_keys']):
+        for fk in meta['foreign_keys'][table]:
+            result.append({
+                'from_table': table,
+                'from_column': fk['column_name'],
+                'to_table': fk['foreign_table'],
+                'to_column': fk['foreign_column'],
+                'update_rule': fk['update_rule'],
+                'delete_rule': fk['delete_rule']
+            })
     
     return JSONResponse(content=result)
 
-@app.get("/api/schema/ddl")
-async def get_schema_ddl():
+def build_schema_ddl():
     """Получить SQL DDL для всех таблиц"""
-    tables = db.get_tables()
+    meta = db.get_schema_metadata()
     ddl_parts = []
     
-    for table in tables:
-        # Получаем колонки
-        columns = db.execute_query(f"""
-            SELECT 
-                column_name,
-                data_type,
-                is_nullable,
-                column_default
-            FROM information_schema.columns
-            WHERE table_name = '{table}'
-            ORDER BY ordinal_position
-        """) or []
-        
+    for table in meta['tables']:
         col_defs = []
-        for col in columns:
+        for col in meta['columns'][table]:
             null_str = "NOT NULL" if col['is_nullable'] == 'NO' else ""
             default_str = f"DEFAULT {col['column_default']}" if col['column_default'] else ""
             col_defs.append(f"    {col['column_name']} {col['data_type']} {null_str} {default_str}".strip())
         
-        # Получаем первичный ключ
-        pk = db.execute_query(f"""
-            SELECT 
-                kcu.column_name
-            FROM information_schema.table_constraints tc
-            JOIN information_schema.key_column_usage kcu
-                ON tc.constraint_name = kcu.constraint_name
-            WHERE tc.constraint_type = 'PRIMARY KEY'
-                AND tc.table_name = '{table}'
-        """) or []
-        
-        if pk:
-            pk_cols = [p['column_name'] for p in pk]
+        pk_cols = meta['primary_keys'].get(table)
+        if pk_cols:
             col_defs.append(f"    PRIMARY KEY ({', '.join(pk_cols)})")
         
-        # Получаем внешние ключи
-        fk = db.execute_query(f"""
-            SELECT
-                kcu.column_name,
-                ccu.table_name AS foreign_table,
-                ccu.column_name AS foreign_column
-            FROM information_schema.table_constraints tc
-            JOIN information_schema.key_column_usage kcu
-                ON tc.constraint_name = kcu.constraint_name
-            JOIN information_schema.constraint_column_usage ccu
-                ON ccu.constraint_name = tc.constraint_name
-            WHERE tc.constraint_type = 'FOREIGN KEY'
-                AND tc.table_name = '{table}'
-        """) or []
-        
-        for f in fk:
+        for f in meta['foreign_keys'].get(table, []):
             col_defs.append(
                 f"    FOREIGN KEY ({f['column_name']}) REFERENCES {f['foreign_table']}({f['foreign_column']})"
             )
@@ -249,20 +209,35 @@ async def get_schema_ddl():
         'ddl': '\n'.join(ddl_parts)
     })
 
+@app.get("/api/schema/ddl")
+async def get_schema_ddl():
+    """Получить SQL DDL для всех таблиц"""
+    return await db.run(build_schema_ddl)
+
 # ==================== РАБОТА С ДАННЫМИ ====================
+DATA_PAGE_SIZE = 100
+DATA_PAGE_MAX = 1000
+
 @app.get("/data", response_class=HTMLResponse)
-async def data_forms(request: Request, table: str = "", page: int = 1):
-    tables = db.get_tables()
+async def data_forms(request: Request, table: str = "", cursor: str = "", dir: str = "next",
+                     sort: Optional[str] = None, page: int = 1):
+    tables = await db.run(db.get_tables)
     columns, data, total_count = [], [], 0
-    per_page = 100
+    per_page = DATA_PAGE_SIZE
+    pager = {'next_cursor': None, 'prev_cursor': None, 'sort': sort, 'sort_columns': []}
+    error = None
     
     if table and table in tables:
-        columns = db.get_table_columns(table) or []
-        total_count = db.get_table_count(table)
-        offset = (page - 1) * per_page
-        data = db.get_table_data(table, limit=per_page, offset=offset) or []
+        columns = await db.run(db.get_table_columns, table) or []
+        total_count = await db.run(db.get_table_count, table)
+        try:
+            pager = await db.run(db.get_table_page, table, per_page, cursor or None, dir, sort) or pager
+        except ValueError as e:
+            error = str(e)
+        data = pager.pop('rows', [])
     
     total_pages = (total_count + per_page - 1) // per_page if total_count else 1
+    page = max(1, min(page, total_pages))
     
     return templates.TemplateResponse("data_forms.html", {
         "request": request,
@@ -273,14 +248,35 @@ async def data_forms(request: Request, table: str = "", page: int = 1):
         "page": page,
         "per_page": per_page,
         "total_count": total_count,
-        "total_pages": total_pages
+        "total_pages": total_pages,
+        "next_cursor": pager['next_cursor'],
+        "prev_cursor": pager['prev_cursor'],
+        "sort": pager['sort'],
+        "sort_columns": pager['sort_columns'],
+        "error": error
     })
 
+@app.get("/api/data/page")
+async def get_data_page(table: str, cursor: Optional[str] = None, dir: str = "next",
+                        sort: Optional[str] = None, limit: int = DATA_PAGE_SIZE):
+    """Страница таблицы по курсору (keyset); курсоры next/prev непрозрачны для клиента"""
+    if table not in await db.run(db.get_tables):
+        return {"success": False, "error": f"Таблица {table} не найдена"}
+    limit = max(1, min(limit, DATA_PAGE_MAX))
+    try:
+        page = await db.run(db.get_table_page, table, limit, cursor, dir, sort)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    if page is None:
+        return {"success": False, "error": "Ошибка чтения таблицы"}
+    return {"success": True, "table": table, "limit": limit, **page}
+
 @app.post("/api/data/insert")
 async def insert_data(table: str = Form(...), data: str = Form(...)):
     try:
         data_dict = json.loads(data)
-        result = db.insert_data(table, data_dict)
+        result = await db.run(db.insert_data, table, data_dict)
+        invalidate_spzr(table)
         if result:
             return {"success": True, "message": f"Добавлена запись с ID: {result}"}
         return {"success": False, "error": "Ошибка вставки"}
@@ -294,7 +290,8 @@ async def update_data(table: str = Form(...), data: str = Form(...), condition:
         filtered = {k: v for k, v in data_dict.items() if v}
         if not filtered:
             return {"success": False, "error": "Нет данных"}
-        result = db.update_data(table, filtered, condition)
+        result = await db.run(db.update_data, table, filtered, condition)
+        invalidate_spzr(table)
         if result:
             return {"success": True, "message": "Обновлено"}
         return {"success": False, "error": "Не найдено"}
@@ -307,11 +304,14 @@ async def delete_data(table: str = Form(...), condition: str = Form(...), cascad
         if not condition:
             return {"success": False, "error": "Условие пусто"}
         if cascade:
-            result = db.delete_data(table, condition)
+            result = await db.run(db.delete_data, table, condition)
+            # Каскадное удаление затрагивает и дочерние таблицы
+            invalidate_spzr()
             if result:
                 return {"success": True, "message": "Удалено с каскадом"}
         else:
-            result = db.delete_data_safe(table, condition)
+            result = await db.run(db.delete_data_safe, table, condition)
+            invalidate_spzr(table)
             if isinstance(result, dict):
                 if result.get('success'):
                     return {"success": True, "message": f"Удалено: {result.get('affected_rows', 0)}"}
@@ -326,26 +326,163 @@ async def delete_data(table: str = Form(...), condition: str = Form(...), cascad
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+def parse_bulk_upload(content, filename):
+    """Записи из загруженного CSV (с заголовком) или JSON-массива"""
+    text = content.decode('utf-8-sig')
+    if filename.lower().endswith('.json') or text.lstrip().startswith('['):
+        records = json.loads(text)
+        if not isinstance(records, list):
+            raise ValueError("JSON должен быть массивом объектов")
+        return records
+    return list(csv.DictReader(io.StringIO(text)))
+
+@app.post("/api/data/bulk-insert")
+async def bulk_insert_data(file: UploadFile = File(...), upsert: bool = Form(True)):
+    """Массовая загрузка измерений в product_characteristics (CSV / JSON) одной транзакцией"""
+    try:
+        records = await db.run(parse_bulk_upload, await file.read(), file.filename or "")
+        result = await db.run(db.bulk_insert_measurements, records, upsert)
+        invalidate_spzr('product_characteristics')
+        return {
+            "success": True,
+            "message": f"Добавлено: {result['inserted']}, обновлено: {result['updated']}, отклонено: {len(result['rejected'])}",
+            **result
+        }
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
 # ==================== КОНСТРУКТОР ЗАПРОСОВ ====================
 @app.get("/query", response_class=HTMLResponse)
 async def query_builder(request: Request):
     return templates.TemplateResponse("query_builder.html", {
         "request": request,
-        "tables": db.get_tables()
+        "tables": await db.run(db.get_tables)
     })
 
+# Только чтение: SELECT/VALUES/TABLE без INTO и без нескольких операторов
+READ_STATEMENT = re.compile(
+    r'(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/|\()*(SELECT|VALUES|TABLE)\b',
+    re.IGNORECASE | re.DOTALL
+)
+SELECT_INTO = re.compile(r'\bINTO\b', re.IGNORECASE)
+
+def invalidate_after_query(sql):
+    """
+    Сбросить кэши после запроса конструктора, который мог изменить данные или схему.
+    DDL может стоять после комментария, внутри WITH или во втором операторе —
+    поэтому сбрасывается все, кроме одиночного чтения
+    """
+    if not READ_STATEMENT.match(sql) or SELECT_INTO.search(sql) \
+            or ';' in sql.strip().rstrip(';'):
+        db.invalidate_schema()
+        invalidate_spzr()
+
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "1000"))
+QUERY_TIMEOUT_MS = int(os.getenv("QUERY_TIMEOUT_MS", "30000"))
+QUERY_TIMEOUT_MAX_MS = int(os.getenv("QUERY_TIMEOUT_MAX_MS", "300000"))
+
+def query_timeout(timeout_ms):
+    """Таймаут запроса конструктора в мс: по умолчанию QUERY_TIMEOUT_MS, не больше QUERY_TIMEOUT_MAX_MS"""
+    if not timeout_ms or timeout_ms <= 0:
+        return QUERY_TIMEOUT_MS
+    return min(timeout_ms, QUERY_TIMEOUT_MAX_MS)
+
+async def open_query_stream(sql, params, timeout_ms, query_id):
+    """
+    Запустить потоковое чтение запроса и получить первую порцию до ответа —
+    ошибки SQL и таймаут возвращаются обычным JSON, а не обрывом потока
+    """
+    chunks = db.stream_query(sql, params, timeout_ms=timeout_ms, query_id=query_id)
+    first = await db.run(next, chunks)
+    return chain([first], chunks)
+
 @app.post("/api/query/execute")
-async def execute_query(sql: str = Form(...), params: str = Form("{}")):
+async def execute_query(sql: str = Form(...), params: str = Form("{}"),
+                        max_rows: int = Form(QUERY_MAX_ROWS), offset: int = Form(0),
+                        timeout_ms: int = Form(0), query_id: str = Form(""),
+                        mode: str = Form("json")):
+    """
+    Выполнить запрос конструктора.
+    
+    mode=json   — не больше max_rows строк начиная с offset, has_more — есть продолжение;
+    mode=ndjson — весь результат потоком через серверный курсор.
+    query_id (задается клиентом) позволяет отменить запрос через /api/query/cancel.
+    """
+    query_id = query_id or uuid.uuid4().hex
+    timeout_ms = query_timeout(timeout_ms)
     try:
         params_dict = json.loads(params) if params else {}
-        result = db.execute_query(sql, params_dict, fetch=True)
+        if mode == "ndjson":
+            chunks = await open_query_stream(sql, params_dict, timeout_ms, query_id)
+            invalidate_after_query(sql)
+            return StreamingResponse(
+                db.format_stream(chunks, "ndjson"),
+                media_type="application/x-ndjson",
+                headers={"X-Query-Id": query_id}
+            )
+        max_rows = max(1, min(max_rows, QUERY_MAX_ROWS))
+        offset = max(0, offset)
+        result = await db.run(db.run_query, sql, params_dict, max_rows, offset, timeout_ms, query_id)
+        invalidate_after_query(sql)
         return {
             "success": True,
-            "data": result,
-            "count": len(result) if result else 0
+            "query_id": query_id,
+            "data": result["rows"],
+            "columns": result["columns"],
+            "count": len(result["rows"]),
+            "offset": offset,
+            "has_more": result["has_more"],
+            "rowcount": result["rowcount"]
         }
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        return {"success": False, "query_id": query_id, "error": str(e)}
+
+@app.post("/api/query/cancel")
+async def cancel_query(query_id: str = Form(...)):
+    """Отменить выполняющийся запрос конструктора (pg_cancel_backend)"""
+    if await db.run(db.cancel_query, query_id):
+        return {"success": True, "message": "Запрос отменен"}
+    return {"success": False, "error": "Запрос не найден или уже завершен"}
+
+@app.get("/api/query/running")
+async def get_running_queries():
+    return {"success": True, "queries": db.running_queries()}
+
+QUERY_EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "json": ("application/json", "json")
+}
+
+@app.post("/api/query/export")
+async def export_query(sql: str = Form(...), format: str = Form("csv"), params: str = Form("{}"),
+                       timeout_ms: int = Form(0), query_id: str = Form("")):
+    """
+    Экспорт результата запроса конструктора через серверный курсор:
+    CSV / NDJSON / JSON отдаются потоком, XLSX пишется openpyxl в режиме write_only
+    """
+    query_id = query_id or uuid.uuid4().hex
+    timeout_ms = query_timeout(timeout_ms)
+    filename = f"query_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    try:
+        params_dict = json.loads(params) if params else {}
+        if format in ("excel", "xlsx"):
+            path, name = await db.run(db.export_query_to_xlsx, sql, params_dict, timeout_ms, query_id)
+            return FileResponse(path, filename=name)
+        if format not in QUERY_EXPORT_FORMATS:
+            return JSONResponse(status_code=400, content={"success": False, "error": "Неверный формат"})
+        media_type, ext = QUERY_EXPORT_FORMATS[format]
+        chunks = await open_query_stream(sql, params_dict, timeout_ms, query_id)
+        return StreamingResponse(
+            db.format_stream(chunks, format),
+            media_type=media_type,
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}.{ext}",
+                "X-Query-Id": query_id
+            }
+        )
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"success": False, "query_id": query_id, "error": str(e)})
 
 # ==================== АВТОМАТИЧЕСКАЯ СППР ====================
 @app.get("/spzr", response_class=HTMLResponse)
@@ -354,273 +491,200 @@ async def spzr_dashboard(request: Request):
         "request": request
     })
 
+db.register_statement("spzr_char_weights", """
+    SELECT name, weight, description
+    FROM characteristics
+    ORDER BY weight DESC
+""")
+
 @app.get("/api/spzr/characteristic-weights")
 async def get_characteristic_weights():
     """Получить веса характеристик для круговой диаграммы"""
-    query = """
-        SELECT name, weight, description
-        FROM characteristics
-        ORDER BY weight DESC
-    """
-    chars = db.execute_query(query) or []
+    chars = await db.run(db.execute_prepared, "spzr_char_weights") or []
     return {
         "success": True,
         "characteristics": chars
     }
 
-@app.get("/api/spzr/characteristic-stats")
-async def get_characteristic_stats(delta_x: float = 1.0):
-    """Получить статистику по характеристикам для заданного Δx"""
-    
-    chars_query = "SELECT id, name, delta_x_default FROM characteristics"
-    chars = db.execute_query(chars_query) or []
-    
-    values_query = """
-        SELECT 
-            characteristic_id,
-            real_value,
-            min_norm,
-            max_norm
-        FROM product_characteristics
-    """
-    values = db.execute_query(values_query) or []
-    
-    stats = []
-    for ch in chars:
-        ch_values = [v for v in values if v['characteristic_id'] == ch['id']]
-        if not ch_values:
-            continue
-        
-        gradations = []
-        for v in ch_values:
-            g = calculate_gradations(
-                v['real_value'],
-                v['min_norm'],
-                v['max_norm'],
-                delta_x
-            )
-            gradations.append(g)
-        
-        avg_g = sum(gradations) / len(gradations) if gradations else 0
-        
-        stats.append({
-            'id': ch['id'],
-            'name': ch['name'],
-            'avg_gradations': round(avg_g, 2),
-            'count': len(gradations)
-        })
-    
-    return {
-        "success": True,
-        "stats": stats,
-        "delta_x": delta_x
-    }
+db.register_statement("spzr_characteristics", "SELECT id, name, delta_x_default FROM characteristics")
+db.register_statement("spzr_char_values", """
+    SELECT 
+        characteristic_id,
+        real_value,
+        min_norm,
+        max_norm
+    FROM product_characteristics
+    WHERE characteristic_id IS NOT NULL
+""")
 
-@app.get("/api/spzr/analyze-all")
-async def analyze_all_quality(delta_x: float = 1.0):
-    """Анализ качества всех продуктов от всех поставщиков с заданным Δx"""
+def characteristic_stats_series(deltas):
+    """
+    Средние градации по характеристикам для нескольких Δx.
     
-    query = """
-        SELECT DISTINCT 
-            p.id as product_id,
-            p.name as product_name,
-            s.id as supplier_id,
-            s.name as supplier_name,
-            COUNT(pc.id) as characteristics_count
-        FROM product_characteristics pc
-        JOIN products p ON pc.product_id = p.id
-        JOIN suppliers s ON pc.supplier_id = s.id
-        GROUP BY p.id, p.name, s.id, s.name
-        ORDER BY s.name, p.name
+    Таблица измерений читается один раз, значения группируются по
+    characteristic_id за один проход, все Δx считаются матрицей.
+    Серии кэшируются по Δx, пересчитываются только отсутствующие.
     """
-    combinations = db.execute_query(query) or []
+    cached = {d: spzr_cache.get(('characteristic-stats', d)) for d in deltas}
+    missing = [d for d in dict.fromkeys(deltas) if cached[d] is None]
+    if not missing:
+        return [{"delta_x": d, "stats": cached[d]} for d in deltas]
+    generation = spzr_cache.generation()
     
-    results = []
-    total_quality = 0
-    total_defect = 0
+    chars = db.execute_prepared("spzr_characteristics") or []
+    values = db.execute_prepared("spzr_char_values") or []
     
-    char_stats = {}
+    char_ids, char_index = np.unique(
+        np.array([v['characteristic_id'] for v in values], dtype=np.int64),
+        return_inverse=True
+    )
+    char_index = char_index.reshape(-1)
+    counts = np.bincount(char_index, minlength=len(char_ids)).tolist()
+    position = {ch_id: i for i, ch_id in enumerate(char_ids.tolist())}
     
-    for combo in combinations:
-        chars_query = """
-            SELECT 
-                c.id,
-                c.name,
-                c.unit,
-                c.delta_x_default,
-                c.weight,
-                pc.min_norm,
-                pc.max_norm,
-                pc.real_value
-            FROM product_characteristics pc
-            JOIN characteristics c ON pc.characteristic_id = c.id
-            WHERE pc.product_id = %s AND pc.supplier_id = %s
-        """
-        chars = db.execute_query(chars_query, (combo['product_id'], combo['supplier_id'])) or []
-        
-        if not chars:
-            continue
-        
-        # --- Базовый вердикт (Δx = 1.0) ---
-        base_sum_log2 = 0
-        n = len(chars)
-        
-        for ch in chars:
-            g = calculate_gradations(
-                ch['real_value'], 
-                ch['min_norm'], 
-                ch['max_norm'], 
-                1.0  # базовый Δx
-            )
-            base_sum_log2 += math.log2(g)
-        
-        base_Go = base_sum_log2 / n if n > 0 else 0
-        if base_Go > 0:
-            base_P = math.exp(-math.log(2) / (base_Go * base_Go))
-        else:
-            base_P = math.exp(-math.log(2) / 0.0001)
-        
-        base_is_quality = base_P <= 0.5
-        
-        # --- Текущий расчет с заданным Δx ---
-        char_results = []
-        current_sum_log2 = 0
-        
+    gradations = spzr.gradations_batch(
+        [v['real_value'] for v in values],
+        [v['min_norm'] for v in values],
+        [v['max_norm'] for v in values],
+        missing
+    )
+    
+    for delta_x, row in zip(missing, gradations):
+        sums = np.bincount(char_index, weights=row, minlength=len(char_ids)).tolist()
+        stats = []
         for ch in chars:
-            g = calculate_gradations(
-                ch['real_value'], 
-                ch['min_norm'], 
-                ch['max_norm'], 
-                delta_x
-            )
-            log2_g = math.log2(g)
-            current_sum_log2 += log2_g
-            
-            if ch['id'] not in char_stats:
-                char_stats[ch['id']] = {
-                    'name': ch['name'],
-                    'gradations': []
-                }
-            char_stats[ch['id']]['gradations'].append(g)
+            i = position.get(ch['id'])
+            if i is None:
+                continue
             
-            char_results.append({
+            stats.append({
+                'id': ch['id'],
                 'name': ch['name'],
-                'unit': ch['unit'],
-                'real': round(ch['real_value'], 2),
-                'min': ch['min_norm'],
-                'max': ch['max_norm'],
-                'gradations': g,
-                'log2': round(log2_g, 3),
-                'weight': ch['weight'] or 1,
-                'in_norm': ch['min_norm'] <= ch['real_value'] <= ch['max_norm']
+                'avg_gradations': round(sums[i] / counts[i], 2),
+                'count': counts[i]
             })
-        
-        current_Go = current_sum_log2 / n if n > 0 else 0
-        if current_Go > 0:
-            current_P = math.exp(-math.log(2) / (current_Go * current_Go))
-        else:
-            current_P = math.exp(-math.log(2) / 0.0001)
-        
-        if base_is_quality:
-            total_quality += 1
-        else:
-            total_defect += 1
-        
-        results.append({
-            'product_id': combo['product_id'],
-            'product_name': combo['product_name'],
-            'supplier_id': combo['supplier_id'],
-            'supplier_name': combo['supplier_name'],
-            'characteristics_count': combo['characteristics_count'],
-            'characteristics': char_results[:3],
-            'metrics': {
-                'Ch': n,
-                'Co': round(current_sum_log2, 3),
-                'Go': round(current_Go, 3),
-                'P': round(current_P, 4),
-                'is_quality': base_is_quality,
-                'base_P': round(base_P, 4)
-            }
-        })
+        cached[delta_x] = stats
+        spzr_cache.set(('characteristic-stats', delta_x), stats, SPZR_TABLES, generation)
+    return [{"delta_x": d, "stats": cached[d]} for d in deltas]
+
+@app.get("/api/spzr/characteristic-stats")
+async def get_characteristic_stats(delta_x: float = 1.0):
+    """Получить статистику по характеристикам для заданного Δx"""
     
-    characteristic_stats = []
-    for ch_id, stats in char_stats.items():
-        avg_g = sum(stats['gradations']) / len(stats['gradations']) if stats['gradations'] else 0
-        characteristic_stats.append({
-            'id': ch_id,
-            'name': stats['name'],
-            'avg_gradations': round(avg_g, 2),
-            'count': len(stats['gradations'])
-        })
+    stats = (await db.run(characteristic_stats_series, [delta_x]))[0]["stats"]
     
     return {
         "success": True,
-        "total": len(results),
-        "quality": total_quality,
-        "defect": total_defect,
-        "results": results,
-        "characteristic_stats": characteristic_stats,
+        "stats": stats,
         "delta_x": delta_x
     }
 
-@app.get("/api/spzr/product-detail")
-async def get_product_detail(product_id: int, supplier_id: int, delta_x: float = 1.0):
-    """Детальная информация о конкретном продукте"""
+@app.get("/api/spzr/characteristic-stats-batch")
+async def get_characteristic_stats_batch(deltas: str = "0.2,0.5,1.0,2.0,5.0"):
+    """Статистика по характеристикам сразу для списка Δx (через запятую)"""
+    
+    try:
+        delta_list = [float(d) for d in deltas.split(',') if d.strip()]
+    except ValueError:
+        return {"success": False, "error": "Неверный список Δx"}
+    if not delta_list or any(d <= 0 for d in delta_list):
+        return {"success": False, "error": "Δx должен быть больше 0"}
     
-    info_query = """
-        SELECT 
-            p.name as product_name,
-            p.category,
-            p.description,
-            s.name as supplier_name,
-            s.address,
-            s.phone
-        FROM products p
-        CROSS JOIN suppliers s
-        WHERE p.id = %s AND s.id = %s
+    return {
+        "success": True,
+        "deltas": delta_list,
+        "series": await db.run(characteristic_stats_series, delta_list)
+    }
+
+ANALYSIS_PAGE_MAX = 1000
+
+@app.get("/api/spzr/analyze-all")
+async def analyze_all_quality(delta_x: float = 1.0, limit: Optional[int] = None, cursor: Optional[str] = None,
+                              sort: str = "supplier", verdict: Optional[str] = None,
+                              supplier_id: Optional[int] = None, product_id: Optional[int] = None,
+                              category: Optional[str] = None, search: Optional[str] = None):
+    """
+    Анализ качества всех продуктов от всех поставщиков с заданным Δx.
+
+    Без limit возвращаются все подходящие строки; с limit — страница и next_cursor.
+    total/quality/defect — по всем группам, matched* — по фильтрам.
     """
-    info = db.execute_query(info_query, (product_id, supplier_id))
+    if limit is not None:
+        limit = max(1, min(limit, ANALYSIS_PAGE_MAX))
+    if verdict == "all":
+        verdict = None
+    try:
+        return await db.run(
+            scoring_engine.page, delta_x, limit, cursor, sort, verdict,
+            supplier_id, product_id, category, search
+        )
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+
+db.register_statement("spzr_product_info", """
+    SELECT 
+        p.name as product_name,
+        p.category,
+        p.description,
+        s.name as supplier_name,
+        s.address,
+        s.phone
+    FROM products p
+    CROSS JOIN suppliers s
+    WHERE p.id = $1 AND s.id = $2
+""")
+db.register_statement("spzr_product_chars", """
+    SELECT 
+        c.id,
+        c.name,
+        c.unit,
+        c.delta_x_default,
+        c.weight,
+        pc.min_norm,
+        pc.max_norm,
+        pc.real_value,
+        pc.measurement_date
+    FROM product_characteristics pc
+    JOIN characteristics c ON pc.characteristic_id = c.id
+    WHERE pc.product_id = $1 AND pc.supplier_id = $2
+    ORDER BY c.name
+""")
+
+def compute_product_detail(product_id, supplier_id, delta_x):
+    """Детальная информация о конкретном продукте"""
+    
+    cache_key = ('product-detail', product_id, supplier_id, delta_x)
+    cached = spzr_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    generation = spzr_cache.generation()
+    
+    info = db.execute_prepared("spzr_product_info", (product_id, supplier_id))
     
     if not info:
         return {"success": False, "error": "Продукт не найден"}
     
-    chars_query = """
-        SELECT 
-            c.id,
-            c.name,
-            c.unit,
-            c.delta_x_default,
-            c.weight,
-            pc.min_norm,
-            pc.max_norm,
-            pc.real_value,
-            pc.measurement_date
-        FROM product_characteristics pc
-        JOIN characteristics c ON pc.characteristic_id = c.id
-        WHERE pc.product_id = %s AND pc.supplier_id = %s
-        ORDER BY c.name
-    """
-    chars = db.execute_query(chars_query, (product_id, supplier_id)) or []
+    chars = db.execute_prepared("spzr_product_chars", (product_id, supplier_id)) or []
     
-    char_results = []
-    current_sum_log2 = 0
-    base_sum_log2 = 0
     n = len(chars)
+    scores = spzr.score_groups(
+        [ch['real_value'] for ch in chars],
+        [ch['min_norm'] for ch in chars],
+        [ch['max_norm'] for ch in chars],
+        [0] * n,
+        [1.0, delta_x],
+        n_groups=1
+    )
+    # Текущие градации (для отображения)
+    current_g_all = scores['gradations'][1].tolist()
+    current_log2_all = scores['log2'][1].tolist()
     
-    for ch in chars:
+    char_results = []
+    for ch, current_g, current_log2 in zip(chars, current_g_all, current_log2_all):
         x = ch['real_value']
         xmin = ch['min_norm']
         xmax = ch['max_norm']
         
-        # Базовые градации (для определения качества)
-        base_g = calculate_gradations(x, xmin, xmax, 1.0)
-        base_sum_log2 += math.log2(base_g)
-        
-        # Текущие градации (для отображения)
-        current_g = calculate_gradations(x, xmin, xmax, delta_x)
-        current_log2 = math.log2(current_g)
-        current_sum_log2 += current_log2
-        
         char_results.append({
             'name': ch['name'],
             'unit': ch['unit'],
@@ -633,26 +697,19 @@ async def get_product_detail(product_id: int, supplier_id: int, delta_x: float =
             'in_norm': xmin <= x <= xmax
         })
     
-    # Базовый вердикт
-    base_Go = base_sum_log2 / n if n > 0 else 0
-    if base_Go > 0:
-        base_P = math.exp(-math.log(2) / (base_Go * base_Go))
-    else:
-        base_P = math.exp(-math.log(2) / 0.0001)
-    
+    # Базовый вердикт (по градациям при Δx = 1.0)
+    base_P = scores['P'][0][0].item()
     is_quality = base_P <= 0.5
     
     # Текущие метрики
-    current_Go = current_sum_log2 / n if n > 0 else 0
-    if current_Go > 0:
-        current_P = math.exp(-math.log(2) / (current_Go * current_Go))
-    else:
-        current_P = math.exp(-math.log(2) / 0.0001)
+    current_sum_log2 = scores['Co'][1][0].item()
+    current_Go = scores['Go'][1][0].item()
+    current_P = scores['P'][1][0].item()
     
     # Подсчет отклонений для пояснения
     deviations = sum(1 for c in char_results if not c['in_norm'])
     
-    return {
+    result = {
         "success": True,
         "product": info[0],
         "characteristics": char_results,
@@ -671,69 +728,102 @@ async def get_product_detail(product_id: int, supplier_id: int, delta_x: float =
             "in_norm": n - deviations
         }
     }
+    spzr_cache.set(cache_key, result, SPZR_TABLES, generation)
+    return result
+
+TRAIN_DELTAS = [0.1, 0.2, 0.5, 0.8, 1.0, 1.5, 2.0, 3.0, 5.0]
+# Бисекция: не больше TRAIN_BISECT_STEPS_MAX шагов; Δx округляется до 6 знаков,
+# поэтому отрезок короче шага округления дальше не делится
+TRAIN_BISECT_STEPS_MAX = 60
+TRAIN_BISECT_DIGITS = 6
+
+@app.get("/api/spzr/product-detail")
+async def get_product_detail(product_id: int, supplier_id: int, delta_x: float = 1.0):
+    """Детальная информация о конкретном продукте"""
+    return await db.run(compute_product_detail, product_id, supplier_id, delta_x)
 
 @app.post("/api/spzr/train-all")
-async def train_system_all():
-    """Обучение СППР - подбор оптимального delta_x"""
+async def train_system_all(
+    deltas: Optional[str] = None,
+    search: str = "grid",
+    lo: float = 0.1,
+    hi: float = 5.0,
+    steps: int = 20
+):
+    """
+    Обучение СППР - подбор оптимального delta_x
     
-    query = """
-        SELECT DISTINCT product_id, supplier_id
-        FROM product_characteristics
+    Измерения читаются из БД один раз, все Δx считаются матрицей.
+    deltas — свой список Δx через запятую (по умолчанию TRAIN_DELTAS);
+    search=bisect — поиск Δx делением отрезка [lo, hi] пополам (steps шагов,
+    1..TRAIN_BISECT_STEPS_MAX): доля качественных не убывает с ростом Δx,
+    поэтому отрезок сходится к 50%.
     """
-    combos = db.execute_query(query) or []
     
-    deltas = [0.1, 0.2, 0.5, 0.8, 1.0, 1.5, 2.0, 3.0, 5.0]
+    try:
+        grid = [float(d) for d in deltas.split(',') if d.strip()] if deltas else TRAIN_DELTAS
+    except ValueError:
+        return {"success": False, "error": "Неверный список Δx"}
+    if search not in ("grid", "bisect"):
+        return {"success": False, "error": "Неверный режим поиска"}
+    if any(d <= 0 for d in grid) or lo <= 0 or hi < lo:
+        return {"success": False, "error": "Δx должен быть больше 0"}
+    
+    steps = max(1, min(steps, TRAIN_BISECT_STEPS_MAX))
+    return await db.run(train_delta_grid, grid, search, lo, hi, steps)
+
+db.register_statement("spzr_train_measurements", """
+    SELECT product_id, supplier_id, real_value, min_norm, max_norm
+    FROM product_characteristics
+    WHERE product_id IS NOT NULL AND supplier_id IS NOT NULL
+    ORDER BY product_id, supplier_id, id
+""")
+
+def train_delta_grid(grid, search, lo, hi, steps):
+    """Доли качественных для сетки Δx (или бисекции) и лучший Δx"""
+    rows = db.execute_prepared("spzr_train_measurements") or []
+    
+    pairs = np.array([(r['product_id'], r['supplier_id']) for r in rows], dtype=np.int64).reshape(-1, 2)
+    _, group_index = np.unique(pairs, axis=0, return_inverse=True)
+    group_index = group_index.reshape(-1)
+    n_groups = int(group_index.max()) + 1 if group_index.size else 0
+    real = [r['real_value'] for r in rows]
+    xmin = [r['min_norm'] for r in rows]
+    xmax = [r['max_norm'] for r in rows]
+    
     results = {}
     
-    for delta in deltas:
-        quality_count = 0
-        total = 0
-        
-        for combo in combos:
-            chars = db.execute_query("""
-                SELECT 
-                    real_value, min_norm, max_norm
-                FROM product_characteristics
-                WHERE product_id = %s AND supplier_id = %s
-            """, (combo['product_id'], combo['supplier_id'])) or []
-            
-            if not chars:
-                continue
-            
-            sum_log2 = 0
-            n = len(chars)
-            
-            for ch in chars:
-                g = calculate_gradations(
-                    ch['real_value'],
-                    ch['min_norm'],
-                    ch['max_norm'],
-                    delta
-                )
-                sum_log2 += math.log2(g)
-            
-            Ch = n
-            Co = sum_log2
-            Go = Co / Ch if Ch > 0 else 0
-            
-            if Go > 0:
-                P = math.exp(-math.log(2) / (Go * Go))
+    def evaluate(ds):
+        ds = [d for d in ds if d not in results]
+        if not ds:
+            return
+        quality_counts = spzr.score_groups(
+            real, xmin, xmax, group_index, ds, n_groups=n_groups
+        )['is_quality'].sum(axis=1).tolist()
+        for delta, quality_count in zip(ds, quality_counts):
+            quality_percent = (quality_count / n_groups * 100) if n_groups > 0 else 0
+            results[delta] = {
+                'quality': quality_count,
+                'total': n_groups,
+                'percent': round(quality_percent, 1)
+            }
+    
+    if search == "bisect":
+        evaluate([lo, hi])
+        for _ in range(steps):
+            if hi - lo < 10 ** -TRAIN_BISECT_DIGITS:
+                break
+            mid = round((lo + hi) / 2, TRAIN_BISECT_DIGITS)
+            evaluate([mid])
+            if results[mid]['percent'] < 50:
+                lo = mid
             else:
-                P = math.exp(-math.log(2) / 0.0001)
-            
-            if P <= 0.5:
-                quality_count += 1
-            total += 1
-        
-        quality_percent = (quality_count / total * 100) if total > 0 else 0
-        results[delta] = {
-            'quality': quality_count,
-            'total': total,
-            'percent': round(quality_percent, 1)
-        }
+                hi = mid
+    else:
+        evaluate(grid)
     
     # Находим Δx, при котором доля качественных ближе всего к 50%
-    best_delta = min(deltas, key=lambda d: abs(results[d]['percent'] - 50))
+    best_delta = min(results, key=lambda d: abs(results[d]['percent'] - 50))
     
     return {
         "success": True,
@@ -750,6 +840,10 @@ async def export_spzr_analysis(delta_x: float = 1.0, format: str = "json"):
     if not analysis.get("success"):
         return {"success": False, "error": "Ошибка анализа"}
     
+    return await db.run(write_analysis_export, analysis, delta_x, format)
+
+def write_analysis_export(analysis, delta_x, format):
+    """Файл экспорта СППР анализа (JSON или Excel) — запись выполняется в пуле потоков"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"spzr_analysis_delta{delta_x}_{timestamp}"
     
@@ -865,6 +959,10 @@ async def export_product_detail(
     if not detail["success"]:
         return {"success": False, "error": detail.get("error", "Ошибка")}
     
+    return await db.run(write_product_export, detail, product_id, supplier_id, delta_x, format)
+
+def write_product_export(detail, product_id, supplier_id, delta_x, format):
+    """Файл экспорта детальной информации о продукте (JSON или Excel)"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"product_{product_id}_{supplier_id}_delta{delta_x}_{timestamp}"
     
@@ -1111,77 +1209,222 @@ async def export_product_detail(
 async def service_page(request: Request):
     return templates.TemplateResponse("service.html", {
         "request": request,
-        "tables": db.get_tables()
+        "tables": await db.run(db.get_tables)
     })
 
+# Бэкап по умолчанию: custom (.backup, один поток) или directory (-F d -j N)
+BACKUP_FORMAT = os.getenv('BACKUP_FORMAT', 'custom')
+BACKUP_JOBS = int(os.getenv('BACKUP_JOBS', '4'))
+BACKUP_JOBS_MAX = int(os.getenv('BACKUP_JOBS_MAX', '16'))
+
+def run_backup_job(job, format, parallel, compress):
+    """Фоновый pg_dump: фаза, таблицы и размер на диске пишутся в задачу"""
+    return db.run_backup(format, parallel, compress, job.update)
+
 @app.post("/api/service/backup")
-async def create_backup():
-    success, path, error = db.create_backup()
-    if success:
-        return {"success": True, "message": f"Бэкап создан: {path}"}
-    return {"success": False, "error": error}
+async def create_backup(format: str = Form(BACKUP_FORMAT), parallel: Optional[int] = Form(None),
+                        compress: Optional[int] = Form(None)):
+    """Запустить бэкап в фоне; прогресс — GET /api/service/jobs/{job_id}"""
+    if format not in db.BACKUP_FORMATS:
+        return {"success": False, "error": f"Неизвестный формат бэкапа: {format}"}
+    if format != "directory":
+        parallel = 1
+    parallel = max(1, min(parallel or BACKUP_JOBS, BACKUP_JOBS_MAX))
+    if compress is not None and not 0 <= compress <= 9:
+        return {"success": False, "error": "Уровень сжатия должен быть от 0 до 9"}
+    job = jobs.submit("backup", run_backup_job, format, parallel, compress)
+    return {
+        "success": True,
+        "message": f"Бэкап запущен ({format}, потоков: {parallel})",
+        "job_id": job.id
+    }
 
-@app.post("/api/service/restore")
-async def restore_backup(file: UploadFile = File(...)):
-    if not file.filename.endswith('.backup'):
-        return {"success": False, "error": "Файл должен иметь расширение .backup"}
-    
-    temp = tempfile.NamedTemporaryFile(delete=False, suffix=".backup")
-    temp.write(await file.read())
+@app.get("/api/service/backups")
+async def list_backups():
+    """Созданные бэкапы с размером и длительностью"""
+    return {"success": True, "backups": await db.run(db.list_backups)}
+
+@app.get("/api/spzr/cache-stats")
+async def spzr_cache_stats():
+    """Счетчики попаданий/промахов кэша СППР"""
+    return {"success": True, "cache": spzr_cache.stats(), "scoring": scoring_engine.stats()}
+
+@app.get("/api/service/pool-stats")
+async def pool_stats():
+    """Метрики пула соединений"""
+    return {"success": True, "pool": db.pool_stats()}
+
+@app.get("/api/service/statement-stats")
+async def statement_stats():
+    """Вызовы, подготовки (PREPARE) и время выполнения частых запросов СППР"""
+    return {"success": True, "statements": db.statement_stats()}
+
+@app.get("/api/service/index-advice")
+async def index_advice(top: int = 10):
+    """Рекомендации по индексам: недостающие из набора приложения, FK без индекса, статистика сканирований"""
+    return {"success": True, **await db.run(db.index_advice, max(1, min(top, 100)))}
+
+@app.post("/api/service/indexes")
+async def ensure_indexes():
+    """Создать недостающие индексы набора приложения (CREATE INDEX CONCURRENTLY)"""
+    created = await db.run(db.ensure_indexes, True)
+    return {"success": True, "created": created}
+
+# Загрузки пишутся на диск частями; восстановление идет фоновой задачей
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+RESTORE_JOBS = int(os.getenv('RESTORE_JOBS', '4'))
+
+async def save_upload(file: UploadFile, suffix):
+    """Скопировать загрузку во временный файл по UPLOAD_CHUNK_SIZE байт, не читая ее целиком в память"""
+    temp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, mode='wb')
+    try:
+        await db.run(shutil.copyfileobj, file.file, temp, UPLOAD_CHUNK_SIZE)
+    except Exception:
+        temp.close()
+        os.unlink(temp.name)
+        raise
     temp.close()
+    return temp.name
+
+def run_restore_job(job, path, parallel, uploaded):
+    """Фоновый pg_restore; загруженный временный файл удаляется по завершении"""
+    try:
+        return db.run_restore(path, parallel, job.update)
+    finally:
+        invalidate_spzr()
+        if uploaded:
+            os.unlink(path)
+
+def run_restore_sql_job(job, path):
+    """Фоновое выполнение SQL файла через psql"""
+    try:
+        success, message = db.restore_from_sql(path, job.update)
+    finally:
+        invalidate_spzr()
+        os.unlink(path)
+    if not success:
+        raise RuntimeError(message)
+    return {"message": message}
+
+@app.post("/api/service/restore")
+async def restore_backup(file: Optional[UploadFile] = File(None), backup: Optional[str] = Form(None),
+                         parallel: Optional[int] = Form(None)):
+    """
+    Запустить восстановление в фоне: из загруженного .backup или из бэкапа
+    на сервере (backup — имя из /api/service/backups, в т.ч. каталог).
+    Прогресс — GET /api/service/jobs/{job_id}.
+    """
+    parallel = max(1, min(parallel or RESTORE_JOBS, BACKUP_JOBS_MAX))
+    if backup:
+        found = [b for b in await db.run(db.list_backups) if b['file'] == backup]
+        if not found:
+            return {"success": False, "error": f"Бэкап {backup} не найден"}
+        path, uploaded = found[0]['path'], False
+    else:
+        if file is None or not file.filename:
+            return {"success": False, "error": "Выберите файл .backup"}
+        if not file.filename.endswith('.backup'):
+            return {"success": False, "error": "Файл должен иметь расширение .backup"}
+        path, uploaded = await save_upload(file, ".backup"), True
     
-    success, message = db.restore_backup(temp.name)
-    os.unlink(temp.name)
+    try:
+        format = await db.run(db.archive_format, path)
+    except OSError:
+        format = None
+    if format is None:
+        if uploaded:
+            os.unlink(path)
+        return {"success": False, "error": "Файл не является архивом pg_dump"}
     
-    if success:
-        return {"success": True, "message": message}
-    return {"success": False, "error": message}
+    job = jobs.submit("restore", run_restore_job, path, parallel, uploaded)
+    return {
+        "success": True,
+        "message": f"Восстановление запущено ({format}, потоков: {1 if format == 'tar' else parallel})",
+        "job_id": job.id
+    }
 
 @app.post("/api/service/restore-sql")
 async def restore_sql(file: UploadFile = File(...)):
+    """Запустить выполнение SQL файла в фоне; прогресс — GET /api/service/jobs/{job_id}"""
     if not file.filename.endswith('.sql'):
         return {"success": False, "error": "Файл должен иметь расширение .sql"}
     
-    temp = tempfile.NamedTemporaryFile(delete=False, suffix=".sql", mode='wb')
-    temp.write(await file.read())
-    temp.close()
-    
-    success, message = db.restore_from_sql(temp.name)
-    os.unlink(temp.name)
-    
-    if success:
-        return {"success": True, "message": message}
-    return {"success": False, "error": message}
+    path = await save_upload(file, ".sql")
+    job = jobs.submit("restore-sql", run_restore_sql_job, path)
+    return {"success": True, "message": "Выполнение SQL файла запущено", "job_id": job.id}
 
 @app.post("/api/table/delete")
 async def drop_table(table: str = Form(...)):
-    if db.drop_table(table):
+    dropped = await db.run(db.drop_table, table)
+    invalidate_spzr()
+    if dropped:
         return {"success": True, "message": f"Таблица '{table}' удалена"}
     return {"success": False, "error": "Ошибка удаления"}
 
+def run_archive_job(job, tables):
+    """Фоновая архивация: прогресс по таблицам пишется в задачу"""
+    try:
+        success, result = db.archive_tables(tables, job.update_item)
+    finally:
+        invalidate_spzr()
+    if not success:
+        raise RuntimeError(result)
+    return result
+
 @app.post("/api/service/archive")
 async def archive_tables(tables: str = Form("[]"), archive_all: bool = Form(False)):
-    tables_list = json.loads(tables) if not archive_all else db.get_tables()
+    """Запустить архивацию в фоне; прогресс — GET /api/service/jobs/{job_id}"""
+    tables_list = json.loads(tables) if not archive_all else await db.run(db.get_tables)
     if not tables_list:
         return {"success": False, "error": "Нет таблиц"}
-    success, result = db.archive_tables(tables_list)
-    if success:
-        return {
-            "success": True,
-            "message": result["message"],
-            "archive_dir": result["archive_dir"],
-            "tables_archived": result["tables_archived"],
-            "details": result.get("details", [])
-        }
-    return {"success": False, "error": result}
+    job = jobs.submit("archive", run_archive_job, tables_list, items=tables_list)
+    return {
+        "success": True,
+        "message": f"Архивация запущена: {len(tables_list)} таблиц",
+        "job_id": job.id
+    }
+
+@app.get("/api/service/jobs")
+async def list_jobs(kind: Optional[str] = None):
+    """Фоновые задачи (новые первыми)"""
+    return {"success": True, "jobs": jobs.list(kind)}
+
+@app.get("/api/service/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Статус фоновой задачи с прогрессом по элементам"""
+    job = jobs.get(job_id)
+    if job is None:
+        return {"success": False, "error": "Задача не найдена"}
+    return {"success": True, **job.to_dict()}
 
 # ==================== ЭКСПОРТ ====================
+# CSV-форматы выгружаются через COPY ... TO STDOUT (csv.gz — со сжатием gzip)
+COPY_FORMATS = {"csv": False, "csv.gz": True}
+
+def copy_export_response(path, name, stats):
+    """Файл экспорта (COPY, Parquet, Arrow) + статистика скорости в заголовках"""
+    return FileResponse(path, filename=name, headers={
+        "X-Export-Rows": str(stats['rows']),
+        "X-Export-Seconds": str(stats['seconds']),
+        "X-Export-Rows-Per-Sec": str(stats['rows_per_sec'])
+    })
+
 @app.get("/api/export/table/{table_name}/{format}")
 async def export_table(table_name: str, format: str):
+    if format in COPY_FORMATS:
+        path, name, stats = await db.run(db.export_table_to_csv, table_name, COPY_FORMATS[format])
+        if path:
+            return copy_export_response(path, name, stats)
+        return {"success": False, "error": name}
+    if format in db.COLUMNAR_FORMATS:
+        path, name, stats = await db.run(db.export_table_to_columnar, table_name, format)
+        if path:
+            return copy_export_response(path, name, stats)
+        return {"success": False, "error": name}
     if format == "excel":
-        path, name = db.export_table_to_excel(table_name)
+        path, name = await db.run(db.export_table_to_excel, table_name)
     elif format == "json":
-        path, name = db.export_table_to_json(table_name)
+        path, name = await db.run(db.export_table_to_json, table_name)
     else:
         return {"success": False, "error": "Неверный формат"}
     
@@ -1189,23 +1432,106 @@ async def export_table(table_name: str, format: str):
         return FileResponse(path, filename=name)
     return {"success": False, "error": name}
 
+STREAM_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson")
+}
+
+@app.get("/api/export/stream/{table_name}/{format}")
+async def export_table_stream(table_name: str, format: str):
+    """Потоковый экспорт таблицы (CSV / NDJSON) через серверный курсор"""
+    if format not in STREAM_FORMATS:
+        return {"success": False, "error": "Неверный формат"}
+    if table_name not in await db.run(db.get_tables):
+        return {"success": False, "error": "Таблица не найдена"}
+    
+    media_type, ext = STREAM_FORMATS[format]
+    filename = f"{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+    return StreamingResponse(
+        db.stream_table_export(table_name, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@app.get("/api/export/watermarks")
+async def get_export_watermarks():
+    """Колонки-отметки для инкрементального экспорта по всем таблицам"""
+    tables = await db.run(db.get_tables)
+    watermarks = {}
+    for table in tables:
+        watermarks[table] = await db.run(db.get_watermark_columns, table)
+    return {"success": True, "watermarks": watermarks}
+
+@app.get("/api/export/incremental/{table_name}/{format}")
+async def export_table_incremental(table_name: str, format: str,
+                                   since: Optional[str] = None, column: Optional[str] = None):
+    """
+    Инкрементальный экспорт: только строки после отметки since (CSV / NDJSON / JSON).
+    
+    Новая отметка возвращается в X-Export-Watermark — ее передают как since
+    при следующей выгрузке. column — колонка-отметка (по умолчанию первая
+    из /api/export/watermarks).
+    """
+    if format not in QUERY_EXPORT_FORMATS:
+        return JSONResponse(status_code=400, content={"success": False, "error": "Неверный формат"})
+    if table_name not in await db.run(db.get_tables):
+        return JSONResponse(status_code=404, content={"success": False, "error": "Таблица не найдена"})
+    try:
+        info, query, params = await db.run(db.incremental_export_query, table_name, since, column)
+        chunks = await open_query_stream(query, params, None, None)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
+    
+    media_type, ext = QUERY_EXPORT_FORMATS[format]
+    filename = f"{table_name}_incremental_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+    return StreamingResponse(
+        db.format_stream(chunks, format),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "X-Export-Watermark": str(info['watermark']),
+            "X-Export-Watermark-Column": info['column'],
+            "X-Export-Since": "" if info['since'] is None else str(info['since'])
+        }
+    )
+
 @app.post("/api/export/tables")
 async def export_tables(tables: List[str] = Form(...), format: str = Form("excel")):
+    if format in COPY_FORMATS:
+        path, name, stats = await db.run(db.export_tables_to_csv, tables, COPY_FORMATS[format])
+        if path:
+            return copy_export_response(path, name, stats)
+        return {"success": False, "error": name}
+    if format in db.COLUMNAR_FORMATS:
+        path, name, stats = await db.run(db.export_tables_to_columnar, tables, format)
+        if path:
+            return copy_export_response(path, name, stats)
+        return {"success": False, "error": name}
     if format == "excel":
-        path, name = db.export_tables_to_excel(tables)
+        path, name = await db.run(db.export_tables_to_excel, tables)
     else:
-        path, name = db.export_tables_to_json(tables)
+        path, name = await db.run(db.export_tables_to_json, tables)
     if path:
         return FileResponse(path, filename=name)
     return {"success": False, "error": name}
 
 @app.get("/api/export/all/{format}")
 async def export_all_tables(format: str):
-    tables = db.get_tables()
+    tables = await db.run(db.get_tables)
+    if format in COPY_FORMATS:
+        path, name, stats = await db.run(db.export_tables_to_csv, tables, COPY_FORMATS[format])
+        if path:
+            return copy_export_response(path, name, stats)
+        return {"success": False, "error": name}
+    if format in db.COLUMNAR_FORMATS:
+        path, name, stats = await db.run(db.export_tables_to_columnar, tables, format)
+        if path:
+            return copy_export_response(path, name, stats)
+        return {"success": False, "error": name}
     if format == "excel":
-        path, name = db.export_tables_to_excel(tables)
+        path, name = await db.run(db.export_tables_to_excel, tables)
     else:
-        path, name = db.export_tables_to_json(tables)
+        path, name = await db.run(db.export_tables_to_json, tables)
     if path:
         return FileResponse(path, filename=name)
     return {"success": False, "error": name}
@@ -55,6 +55,12 @@ def init_db():
         )
     """, fetch=False)
     
+    # Индексы под запросы приложения (Database.MANAGED_INDEXES)
+    db.ensure_indexes()
+    
+    # Сводка качества по группам и триггеры, поддерживающие ее
+    db.ensure_quality_scores()
+    
     # ============ ЗАПОЛНЕНИЕ ДАННЫМИ ============
     
     # Поставщики (6+)
@@ -211,4 +217,5 @@ def init_db():
               pid, sid, char_ids["Соответствие размеру"],
               pid, sid, char_ids["Качество упаковки"]), fetch=False)
     
+    db.close()
     print("✅ База данных склада одежды инициализирована (Вариант 19)")
\ No newline at end of file
@@ -0,0 +1,515 @@
+"""
+Инкрементальный пересчет анализа качества (analyze-all).
+
+Для каждого активного Δx движок хранит разбор по группам (продукт × поставщик):
+строку результата, частичные суммы Co/Ch и вклад группы в статистику
+характеристик. Триггер на product_characteristics пишет затронутые группы в
+quality_changes (с xid транзакции); перед ответом движок читает изменения
+после своей отметки и пересчитывает только эти группы — стоимость записи
+зависит от размера изменения, а не от каталога.
+
+Отметка — xmin снимка PostgreSQL: все транзакции с меньшим xid завершены,
+поэтому изменение не теряется, даже если транзакции фиксируются не по порядку
+(повторный пересчет группы безопасен).
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+import spzr
+
+MEASUREMENTS_SELECT = """
+    SELECT
+        p.id as product_id,
+        p.name as product_name,
+        p.category,
+        s.id as supplier_id,
+        s.name as supplier_name,
+        c.id,
+        c.name,
+        c.unit,
+        c.delta_x_default,
+        c.weight,
+        pc.min_norm,
+        pc.max_norm,
+        pc.real_value,
+        quality_measurement_hash(pc.real_value, pc.min_norm, pc.max_norm) AS checksum
+    FROM product_characteristics pc
+    JOIN products p ON pc.product_id = p.id
+    JOIN suppliers s ON pc.supplier_id = s.id
+    LEFT JOIN characteristics c ON pc.characteristic_id = c.id
+"""
+MEASUREMENTS_ORDER = "ORDER BY s.name, p.name, s.id, p.id, pc.id"
+GROUPS_FILTER = "(product_id, supplier_id) IN (SELECT * FROM unnest($1::int[], $2::int[]))"
+
+# Сортировки среза analyze-all (как в дашборде): ключ по строке результата,
+# последним элементом всегда добавляется позиция группы в порядке поставщик + продукт
+ANALYSIS_SORTS = {
+    'supplier': lambda r: (),
+    'product': lambda r: (r['product_name'],),
+    'quality_first': lambda r: (not r['metrics']['is_quality'], r['metrics']['P']),
+    'defect_first': lambda r: (r['metrics']['is_quality'], -r['metrics']['P']),
+    'p_asc': lambda r: (r['metrics']['P'],),
+    'p_desc': lambda r: (-r['metrics']['P'],),
+    'go_asc': lambda r: (r['metrics']['Go'],),
+    'go_desc': lambda r: (-r['metrics']['Go'],),
+    'co_asc': lambda r: (r['metrics']['Co'],),
+    'co_desc': lambda r: (-r['metrics']['Co'],),
+}
+ANALYSIS_VERDICTS = {'quality': True, 'defect': False}
+
+
+def score_rows(rows, deltas, base=None):
+    """
+    Разбор измерений по группам для нескольких Δx одним пакетом.
+
+    rows — измерения в порядке MEASUREMENTS_ORDER; base — строки quality_scores
+    по ключу (product_id, supplier_id): базовый вердикт (Δx = 1.0) берется из
+    них, если с измерениями сходятся счетчики и контрольная сумма значений,
+    иначе считается вместе с deltas.
+    Возвращает (keys, {Δx: {ключ: группа}}), keys — группы в порядке rows.
+    """
+    groups = []
+    for _, group in groupby(rows, key=lambda r: (r['product_id'], r['supplier_id'])):
+        group = list(group)
+        chars = [r for r in group if r['id'] is not None]
+        if chars:
+            groups.append((group[0], len(group), chars, sum(r['checksum'] for r in group)))
+
+    base = base or {}
+    base_rows = [base.get((combo['product_id'], combo['supplier_id'])) for combo, *_ in groups]
+    use_base = all(
+        b is not None and b['ch'] == len(chars) and b['measurements'] == count
+        and b['checksum'] == checksum
+        for b, (_, count, chars, checksum) in zip(base_rows, groups)
+    )
+    groups = [group[:3] for group in groups]
+    deltas = list(deltas)
+    batch = deltas if use_base else [1.0] + deltas
+
+    measurements = [ch for _, _, chars in groups for ch in chars]
+    scores = spzr.score_groups(
+        [ch['real_value'] for ch in measurements],
+        [ch['min_norm'] for ch in measurements],
+        [ch['max_norm'] for ch in measurements],
+        np.repeat(np.arange(len(groups)), [len(chars) for _, _, chars in groups]),
+        batch,
+        n_groups=len(groups)
+    )
+    if use_base:
+        base_P_all = [spzr.quality_probability(b['co'] / b['ch']) for b in base_rows]
+    else:
+        base_P_all = scores['P'][0].tolist()
+
+    keys = [(combo['product_id'], combo['supplier_id']) for combo, _, _ in groups]
+    by_delta = {}
+    for d, delta_x in enumerate(deltas):
+        row = d if use_base else d + 1
+        current_P_all = scores['P'][row].tolist()
+        current_Co_all = scores['Co'][row].tolist()
+        current_Go_all = scores['Go'][row].tolist()
+        current_g_all = scores['gradations'][row].tolist()
+        current_log2_all = scores['log2'][row].tolist()
+
+        entries = {}
+        offset = 0
+        for i, (combo, characteristics_count, chars) in enumerate(groups):
+            n = len(chars)
+            base_P = base_P_all[i]
+            base_is_quality = base_P <= spzr.QUALITY_THRESHOLD
+
+            char_results = []
+            char_gradations = []
+            for j, ch in enumerate(chars):
+                g = current_g_all[offset + j]
+                log2_g = current_log2_all[offset + j]
+                char_gradations.append((ch['id'], ch['name'], g))
+                char_results.append({
+                    'name': ch['name'],
+                    'unit': ch['unit'],
+                    'real': round(ch['real_value'], 2),
+                    'min': ch['min_norm'],
+                    'max': ch['max_norm'],
+                    'gradations': g,
+                    'log2': round(log2_g, 3),
+                    'weight': ch['weight'] or 1,
+                    'in_norm': ch['min_norm'] <= ch['real_value'] <= ch['max_norm']
+                })
+            offset += n
+
+            entries[keys[i]] = {
+                'is_quality': base_is_quality,
+                'category': combo['category'],
+                'char_gradations': char_gradations,
+                'result': {
+                    'product_id': combo['product_id'],
+                    'product_name': combo['product_name'],
+                    'supplier_id': combo['supplier_id'],
+                    'supplier_name': combo['supplier_name'],
+                    'characteristics_count': characteristics_count,
+                    'characteristics': char_results[:3],
+                    'metrics': {
+                        'Ch': n,
+                        'Co': round(current_Co_all[i], 3),
+                        'Go': round(current_Go_all[i], 3),
+                        'P': round(current_P_all[i], 4),
+                        'is_quality': base_is_quality,
+                        'base_P': round(base_P, 4)
+                    }
+                }
+            }
+        by_delta[delta_x] = entries
+    return keys, by_delta
+
+
+class ScoringEngine:
+    """
+    Кэш analyze-all по Δx с дозаписью изменений.
+
+    max_deltas — сколько Δx держать (LRU); ttl — полный пересчет не реже раза
+    в ttl секунд; retention — сколько хранится журнал quality_changes.
+    Если измененных групп больше 1/rebuild_ratio от всех или появилась новая
+    группа (ее место в сортировке по именам задает PostgreSQL), Δx пересчитывается целиком.
+    """
+
+    def __init__(self, db, max_deltas=8, ttl=600.0, retention=3600.0, rebuild_ratio=4):
+        self.db = db
+        self.max_deltas = max_deltas
+        self.ttl = ttl
+        self.retention = retention
+        self.rebuild_ratio = rebuild_ratio
+        self._states = OrderedDict()
+        self._watermark = None
+        self._synced_at = 0.0
+        self._epoch = 0
+        # защищает только _states / _watermark / _epoch / _stats: чтение из БД
+        # и расчет идут вне блокировки, готовое состояние подменяется целиком
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'full_builds': 0, 'patches': 0, 'patched_groups': 0, 'resets': 0}
+
+        db.register_statement("spzr_all_measurements", MEASUREMENTS_SELECT + MEASUREMENTS_ORDER)
+        db.register_statement(
+            "spzr_group_measurements",
+            MEASUREMENTS_SELECT + "WHERE (pc.product_id, pc.supplier_id) IN "
+            "(SELECT * FROM unnest($1::int[], $2::int[]))\n" + MEASUREMENTS_ORDER
+        )
+        db.register_statement("spzr_quality_scores", """
+            SELECT product_id, supplier_id, measurements, ch, co, checksum
+            FROM spzr.quality_scores
+        """)
+        db.register_statement("spzr_group_scores", f"""
+            SELECT product_id, supplier_id, measurements, ch, co, checksum
+            FROM spzr.quality_scores
+            WHERE {GROUPS_FILTER}
+        """)
+        db.register_statement(
+            "spzr_watermark",
+            "SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS watermark"
+        )
+        db.register_statement("spzr_quality_changes", """
+            WITH w AS (SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS watermark)
+            SELECT w.watermark, c.changed, c.reset, c.product_id, c.supplier_id
+            FROM w
+            LEFT JOIN (
+                SELECT DISTINCT TRUE AS changed, reset, product_id, supplier_id
+                FROM spzr.quality_changes
+                WHERE xid >= $1::xid8
+            ) c ON TRUE
+        """)
+
+    def invalidate(self, table=None):
+        """Сбросить состояние при изменении справочников (имена, единицы, веса)"""
+        if table in (None, 'products', 'suppliers', 'characteristics'):
+            with self._lock:
+                self._reset()
+
+    def _reset(self):
+        # вызывается под self._lock; расчеты, начатые до сброса, не публикуются
+        if self._states:
+            self._stats['resets'] += 1
+        self._states.clear()
+        self._watermark = None
+        self._epoch += 1
+
+    def page(self, delta_x, limit=None, cursor=None, sort='supplier', verdict=None,
+             supplier_id=None, product_id=None, category=None, search=None):
+        """
+        Срез analyze-all: фильтры, сортировка и страница по курсору.
+
+        Итоги total/quality/defect и статистика характеристик — по всем группам,
+        matched/matched_quality — по отфильтрованным; сериализуются только
+        строки страницы. limit=None — все подходящие строки.
+        """
+        sort_key = ANALYSIS_SORTS.get(sort)
+        if sort_key is None:
+            raise ValueError(f"Неизвестная сортировка: {sort}")
+        if verdict is not None and verdict not in ANALYSIS_VERDICTS:
+            raise ValueError(f"Неизвестный вердикт: {verdict}")
+        after = tuple(self.db.decode_cursor(cursor)) if cursor else None
+        search = search.lower() if search else None
+
+        # состояние не меняется после публикации — фильтры и сортировка без блокировки
+        state = self._state(delta_x)
+        if state is None:
+            return {"success": False, "error": "Ошибка чтения измерений"}
+
+        matched = matched_quality = 0
+        candidates = []
+        for position, key in enumerate(state['order']):
+            entry = state['entries'][key]
+            result = entry['result']
+            if verdict is not None and entry['is_quality'] != ANALYSIS_VERDICTS[verdict]:
+                continue
+            if supplier_id is not None and key[1] != supplier_id:
+                continue
+            if product_id is not None and key[0] != product_id:
+                continue
+            if category is not None and entry['category'] != category:
+                continue
+            if search and search not in result['supplier_name'].lower() \
+                    and search not in result['product_name'].lower():
+                continue
+            matched += 1
+            matched_quality += entry['is_quality']
+            candidates.append((sort_key(result) + (position,), result))
+
+        try:
+            if after is not None:
+                candidates = [c for c in candidates if c[0] > after]
+        except TypeError:
+            raise ValueError("Некорректный курсор")
+        if limit is None:
+            rows = sorted(candidates, key=itemgetter(0))
+        else:
+            rows = heapq.nsmallest(limit + 1, candidates, key=itemgetter(0))
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit]
+        total = len(state['order'])
+
+        return {
+            "success": True,
+            "total": total,
+            "quality": state['quality'],
+            "defect": total - state['quality'],
+            "matched": matched,
+            "matched_quality": matched_quality,
+            "matched_defect": matched - matched_quality,
+            "results": [result for _, result in rows],
+            "characteristic_stats": self._characteristic_stats(state),
+            "delta_x": delta_x,
+            "sort": sort,
+            "next_cursor": self.db.encode_cursor(list(rows[-1][0])) if has_more else None
+        }
+
+    def _state(self, delta_x):
+        """Актуальное состояние Δx: дописать журнал, при необходимости посчитать заново"""
+        self._sync()
+        with self._lock:
+            state = self._states.get(delta_x)
+            if state is not None and time.monotonic() - state['built_at'] <= self.ttl:
+                self._states.move_to_end(delta_x)
+                self._stats['hits'] += 1
+                return state
+        return self._build(delta_x)
+
+    # ---------- Полный расчет ----------
+    def _build(self, delta_x):
+        """
+        Полный расчет Δx вне блокировки. Отметка снимается до чтения измерений:
+        все транзакции до нее уже видны в прочитанных строках.
+        """
+        with self._lock:
+            epoch = self._epoch
+        mark = self.db.execute_prepared("spzr_watermark")
+        if not mark:
+            return None
+        watermark = mark[0]['watermark']
+
+        rows = self.db.execute_prepared("spzr_all_measurements")
+        if rows is None:
+            return None
+        base = {
+            (r['product_id'], r['supplier_id']): r
+            for r in self.db.execute_prepared("spzr_quality_scores") or []
+        }
+        keys, by_delta = score_rows(rows, [delta_x], base)
+        entries = by_delta[delta_x]
+
+        state = {
+            'built_at': time.monotonic(),
+            'order': keys,
+            'entries': entries,
+            'quality': 0,
+            'char_sums': {}
+        }
+        for entry in entries.values():
+            self._account(state, entry, +1)
+
+        with self._lock:
+            self._stats['full_builds'] += 1
+            if epoch != self._epoch:
+                # справочники сброшены во время расчета — результат только для этого запроса
+                return state
+            # общая отметка не может быть новее строк, из которых посчитано состояние
+            if self._watermark is None:
+                self._synced_at = time.monotonic()
+            if self._watermark is None or int(watermark) < int(self._watermark):
+                self._watermark = watermark
+            self._states[delta_x] = state
+            self._states.move_to_end(delta_x)
+            while len(self._states) > self.max_deltas:
+                self._states.popitem(last=False)
+        return state
+
+    # ---------- Инкрементальный пересчет ----------
+    def _sync(self):
+        """
+        Прочитать журнал изменений после отметки и пересчитать затронутые группы.
+
+        Чтение и расчет идут вне блокировки, состояния копируются и заменяются
+        целиком. Если за это время состояния или отметка изменились другим
+        запросом, результат отбрасывается — отметка не сдвигается, и следующий
+        запрос прочитает те же изменения.
+        """
+        with self._lock:
+            if not self._states or self._watermark is None:
+                return
+            # журнал старше retention удаляет триггер — слишком старую отметку не догнать
+            if time.monotonic() - self._synced_at > self.retention / 2:
+                self._reset()
+                return
+            epoch = self._epoch
+            watermark = self._watermark
+            states = dict(self._states)
+
+        changes = self.db.execute_prepared("spzr_quality_changes", (watermark,))
+        changed = [r for r in changes or [] if r['changed']]
+        if not changes or any(r['reset'] for r in changed):
+            self._reset_if(epoch)
+            return
+        keys = list(dict.fromkeys(
+            (r['product_id'], r['supplier_id']) for r in changed
+            if r['product_id'] is not None and r['supplier_id'] is not None
+        ))
+
+        patched = {}
+        if keys:
+            patched = self._patch(keys, states)
+            if patched is None:
+                self._reset_if(epoch)
+                return
+
+        with self._lock:
+            if epoch != self._epoch or watermark != self._watermark or \
+                    any(self._states.get(d) is not st for d, st in states.items()) or \
+                    len(self._states) != len(states):
+                return
+            for delta_x, state in patched.items():
+                if state is None:
+                    del self._states[delta_x]
+                else:
+                    self._states[delta_x] = state
+            self._watermark = changes[0]['watermark']
+            self._synced_at = time.monotonic()
+            if keys:
+                self._stats['patches'] += 1
+                self._stats['patched_groups'] += len(keys)
+
+    def _reset_if(self, epoch):
+        with self._lock:
+            if epoch == self._epoch:
+                self._reset()
+
+    def _patch(self, keys, states):
+        """
+        Новые состояния {Δx: state} с пересчитанными группами keys (None — Δx
+        посчитать заново); None — сбросить все
+        """
+        if any(len(keys) * self.rebuild_ratio > len(s['entries']) for s in states.values()):
+            return None
+
+        params = ([k[0] for k in keys], [k[1] for k in keys])
+        rows = self.db.execute_prepared("spzr_group_measurements", params)
+        if rows is None:
+            return None
+        base = {
+            (r['product_id'], r['supplier_id']): r
+            for r in self.db.execute_prepared("spzr_group_scores", params) or []
+        }
+        _, by_delta = score_rows(rows, list(states), base)
+
+        patched = {}
+        for delta_x, old_state in states.items():
+            fresh = by_delta[delta_x]
+            if any(k in fresh and k not in old_state['entries'] for k in keys):
+                # новая группа: место в порядке сортировки по именам задает PostgreSQL
+                patched[delta_x] = None
+                continue
+            state = dict(
+                old_state,
+                entries=dict(old_state['entries']),
+                char_sums={c: list(acc) for c, acc in old_state['char_sums'].items()}
+            )
+            removed = False
+            for key in keys:
+                old = state['entries'].get(key)
+                if old is not None:
+                    self._account(state, old, -1)
+                new = fresh.get(key)
+                if new is None:
+                    if old is not None:
+                        del state['entries'][key]
+                        removed = True
+                    continue
+                state['entries'][key] = new
+                self._account(state, new, +1)
+            if removed:
+                state['order'] = [k for k in state['order'] if k in state['entries']]
+            patched[delta_x] = state
+        return patched
+
+    @staticmethod
+    def _account(state, entry, sign):
+        """Добавить (+1) или убрать (-1) вклад группы в итоги и статистику характеристик"""
+        state['quality'] += sign * entry['is_quality']
+        sums = state['char_sums']
+        for char_id, name, g in entry['char_gradations']:
+            acc = sums.setdefault(char_id, [name, 0, 0])
+            acc[1] += sign * g
+            acc[2] += sign
+            if acc[2] == 0:
+                del sums[char_id]
+
+    @staticmethod
+    def _characteristic_stats(state):
+        # порядок характеристик — по первому появлению, как при полном расчете
+        sums = state['char_sums']
+        seen = set()
+        characteristic_stats = []
+        for key in state['order']:
+            if len(seen) == len(sums):
+                break
+            for char_id, _, _ in state['entries'][key]['char_gradations']:
+                if char_id in seen:
+                    continue
+                seen.add(char_id)
+                name, total, count = sums[char_id]
+                characteristic_stats.append({
+                    'id': char_id,
+                    'name': name,
+                    'avg_gradations': round(total / count, 2) if count else 0,
+                    'count': count
+                })
+        return characteristic_stats
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['deltas'] = list(self._states)
+            s['watermark'] = self._watermark
+        return s
@@ -0,0 +1,109 @@
+"""
+СППР: пороговый метод диагностики качества (методичка, стр. 35-38)
+
+Скалярные функции для одного измерения и пакетное ядро на NumPy для массивов
+измерений и сразу нескольких Δx. Пакетное ядро дает те же результаты, что и
+скалярная версия: градации считаются тем же делением и округлением вверх,
+log₂(n) берется из таблицы math.log2, суммы накапливаются в порядке строк.
+"""
+import math
+
+import numpy as np
+
+MIN_GRADATIONS = 2
+MAX_GRADATIONS = 100
+QUALITY_THRESHOLD = 0.5
+
+# log₂(n) для всех допустимых n — градации целые и ограничены сверху
+LOG2_TABLE = np.array([0.0] + [math.log2(n) for n in range(1, MAX_GRADATIONS + 1)])
+
+
+def calculate_gradations(x, xmin, xmax, dx):
+    """
+    Правильный расчет градаций по методичке (стр. 35)
+
+    n = 2, если значение в норме
+    n = (x - xmax)/Δx + 1, если x > xmax
+    n = (xmin - x)/Δx + 1, если x < xmin
+
+    Важно: используем math.ceil для округления вверх
+    """
+    if xmin <= x <= xmax:
+        return 2
+    elif x > xmax:
+        # Отклонение вверх
+        diff = x - xmax
+        n = math.ceil(diff / dx) + 1
+        return max(2, min(n, 100))
+    else:  # x < xmin
+        # Отклонение вниз
+        diff = xmin - x
+        n = math.ceil(diff / dx) + 1
+        return max(2, min(n, 100))
+
+
+def quality_probability(Go):
+    """P = e^(-ln2/Go²) (стр. 38)"""
+    if Go > 0:
+        return math.exp(-math.log(2) / (Go * Go))
+    return math.exp(-math.log(2) / 0.0001)
+
+
+def gradations_batch(real, xmin, xmax, deltas):
+    """
+    Градации для массива измерений.
+
+    deltas — число или последовательность Δx. Для числа возвращается массив
+    формы (N,), для последовательности — матрица (len(deltas), N).
+    """
+    real = np.asarray(real, dtype=np.float64)
+    xmin = np.asarray(xmin, dtype=np.float64)
+    xmax = np.asarray(xmax, dtype=np.float64)
+    dx = np.asarray(deltas, dtype=np.float64)
+    single = dx.ndim == 0
+
+    in_norm = (xmin <= real) & (real <= xmax)
+    diff = np.where(real > xmax, real - xmax, xmin - real)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = np.ceil(diff / np.atleast_1d(dx)[:, None]) + 1
+    n = np.clip(n, MIN_GRADATIONS, MAX_GRADATIONS)
+    g = np.where(in_norm, MIN_GRADATIONS, n).astype(np.int64)
+    return g[0] if single else g
+
+
+def score_groups(real, xmin, xmax, group_index, deltas, n_groups=None):
+    """
+    Градации и метрики Ch/Co/Go/P по группам (продукт × поставщик).
+
+    group_index — номер группы для каждого измерения (0..n_groups-1).
+    Возвращает словарь массивов NumPy; у всех, кроме 'Ch', первая ось — Δx:
+        gradations, log2 — (D, N)
+        Co, Go, P, is_quality — (D, G)
+        Ch — (G,)
+    """
+    group_index = np.asarray(group_index, dtype=np.int64)
+    if n_groups is None:
+        n_groups = int(group_index.max()) + 1 if group_index.size else 0
+
+    gradations = gradations_batch(real, xmin, xmax, np.atleast_1d(deltas))
+    log2 = LOG2_TABLE[gradations]
+    Ch = np.bincount(group_index, minlength=n_groups)
+    Co = np.stack([
+        np.bincount(group_index, weights=row, minlength=n_groups) for row in log2
+    ]) if len(log2) else np.zeros((0, n_groups))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Go = np.where(Ch > 0, Co / np.maximum(Ch, 1), 0.0)
+    # Go принимает немного различных значений — P считаем по уникальным
+    unique_Go, inverse = np.unique(Go, return_inverse=True)
+    P = np.array([quality_probability(g) for g in unique_Go.tolist()])[inverse].reshape(Go.shape)
+
+    return {
+        'gradations': gradations,
+        'log2': log2,
+        'Ch': Ch,
+        'Co': Co,
+        'Go': Go,
+        'P': P,
+        'is_quality': P <= QUALITY_THRESHOLD
+    }